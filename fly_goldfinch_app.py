@@ -1,44 +1,26 @@
 import streamlit as st
-import google.generativeai as genai
-import requests
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.colors import Color, lightgrey, black, white
-from reportlab.platypus import Table, TableStyle, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.utils import ImageReader
 from datetime import datetime, timedelta
-import io
 import pandas as pd
-import pypdf
-import re
-import json
-from math import sin, cos, radians
+import os
+import hashlib
+from concurrent.futures import CancelledError
+from voucher_engine import (
+    configure, parse_smart_date, clean_extracted_text, import_manifest,
+    HOTEL_STORE, extract_pdf_data, pdf_digest, pdf_parse_hit_rate, find_hotel_options,
+    voucher_data, manifest_rooms, RoomEntry, JOB_STORE, voucher_jobs, file_slug,
+    Throttled, SEARCH_LIMITER, HOTEL_LOOKUPS,
+)
 
 # =====================================
-# 1) STREAMLIT CONFIG & BRANDING
+# 1) STREAMLIT CONFIG
 # =====================================
-st.set_page_config(page_title="Odaduu Voucher Tool", page_icon="🌏", layout="wide")
-
-BRAND_BLUE = Color(0.05, 0.20, 0.40)
-BRAND_ORANGE = Color(0.97255, 0.29804, 0.0) 
-COMPANY_NAME = "Odaduu Travel DMC"
-COMPANY_EMAIL = "aashwin@odaduu.jp"
-LOGO_FILE = "logo.png"
 
-FOOTER_LINE_Y = 40
-FOOTER_RESERVED_HEIGHT = 110
-MIN_CONTENT_Y = FOOTER_LINE_Y + FOOTER_RESERVED_HEIGHT 
+st.set_page_config(page_title="Odaduu Voucher Tool", page_icon="🌏", layout="wide")
 
 try:
-    GEMINI_KEY = st.secrets["GEMINI_API_KEY"]
-    SEARCH_KEY = st.secrets["SEARCH_API_KEY"]
-    SEARCH_CX = st.secrets["SEARCH_ENGINE_ID"]
-    genai.configure(api_key=GEMINI_KEY)
+    configure(st.secrets["GEMINI_API_KEY"], st.secrets["SEARCH_API_KEY"], st.secrets["SEARCH_ENGINE_ID"])
 except Exception:
-    GEMINI_KEY = None
-    SEARCH_KEY = None
-    SEARCH_CX = None
+    pass  # no Streamlit secrets: keep whatever configure() picked up from the environment
 
 # =====================================
 # 2) SESSION STATE MANAGEMENT
@@ -54,409 +36,83 @@ def init_state():
         'policy_type': 'Non-Refundable', 
         'fetched_room_types': [], 'ai_room_str': '',
         'last_uploaded_file': None, 'bulk_data': [],
+        'last_manifest_file': None, 'manifest_issues': [],
+        'voucher_jobs': [], 'rooms': [], 'hotel_lookup': None, 'hotel_lookup_seen': 0,
         'hotel_images': [None, None, None],
         'selected_hotel_key': None,
         'room_size': '',
         'remarks': '',
         'room_final': '',
         'mode_selection': 'Manual',
+        'split_output': False,
         'uploader_key': 0 # Dynamic key for hard reset
     }
     for k, v in defaults.items():
         if k not in st.session_state:
             st.session_state[k] = v
-            
-    for i in range(50):
-        if f'room_{i}_guest' not in st.session_state: st.session_state[f'room_{i}_guest'] = ''
-        if f'room_{i}_conf' not in st.session_state: st.session_state[f'room_{i}_conf'] = ''
-        if f'room_{i}_adults' not in st.session_state: st.session_state[f'room_{i}_adults'] = 2
-        if f'room_{i}_children' not in st.session_state: st.session_state[f'room_{i}_children'] = 0
 
 init_state()
 
-# =====================================
-# 3) HELPER FUNCTIONS
-# =====================================
-
-def parse_smart_date(date_str):
-    if not date_str: return None
-    clean_str = date_str.strip()
-    clean_str = re.sub(r'\bSept\b', 'Sep', clean_str, flags=re.IGNORECASE)
-    clean_str = re.sub(r'\bSeptember\b', 'Sep', clean_str, flags=re.IGNORECASE)
-    formats = ["%d %b %Y", "%Y-%m-%d", "%d %B %Y"]
-    for fmt in formats:
-        try: return datetime.strptime(clean_str, fmt).date()
-        except ValueError: continue
-    return None
-
-def clean_extracted_text(text):
-    if not isinstance(text, str): return str(text)
-    return text.strip().replace("\n", " ").replace("  ", " ")
+def manual_rooms(n):
+    """The first n manual-mode rooms, growing the session's RoomEntry list on demand (it never shrinks, so lowering the count loses nothing)."""
+    rooms = st.session_state.rooms
+    while len(rooms) < n: rooms.append(RoomEntry())
+    return rooms[:n]
 
-def clean_room_type_string(raw_type):
-    if not isinstance(raw_type, str): return str(raw_type)
-    if raw_type.strip().startswith(('{', '[')) and raw_type.strip().endswith(('}', ']')):
-        try:
-            temp_data = json.loads(raw_type)
-            if isinstance(temp_data, dict): raw_type = list(temp_data.values())[0]
-            elif isinstance(temp_data, list) and temp_data: raw_type = temp_data[0]
-        except json.JSONDecodeError: pass
-    return str(raw_type).strip().strip('\'"{}[] ')
+def _sync_room(i, attr):
+    setattr(st.session_state.rooms[i], attr, st.session_state[f"room_{i}_{attr}"])
 
 # =====================================
-# 4) AI & SEARCH FUNCTIONS
+# 3) HOTEL DATA CALLBACKS
 # =====================================
 
-def extract_pdf_data(pdf_file):
-    if not GEMINI_KEY: return None
-    try:
-        pdf_reader = pypdf.PdfReader(pdf_file)
-        text = "\n".join([p.extract_text() for p in pdf_reader.pages])
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        prompt = f"""You are a Hotel Voucher Parser. Extract details from this text.
-        
-        CRITICAL RULES:
-        1. "rooms": Extract a list. For each room, find 'guest_name', 'confirmation_no', 'adults' (int), and 'children' (int).
-        2. IF "children" count is not explicit, assume 0.
-        3. IF "confirmation_no" is missing, return empty string "".
-        
-        Text content:
-        {text[:25000]}
-        
-        Return JSON ONLY: 
-        {{ 
-            "hotel_name": "Name", "city": "City", 
-            "checkin_raw": "DateStr", "checkout_raw": "DateStr", 
-            "meal_plan": "Plan", "room_type": "Type", "room_size": "Size",
-            "rooms": [ 
-                {{"guest_name": "Name", "confirmation_no": "12345", "adults": 2, "children": 0}} 
-            ] 
-        }}"""
-        
-        raw = model.generate_content(prompt).text
-        clean_json = raw.replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_json)
-    except Exception as e:
-        print(f"PDF Error: {e}")
-        return None
-
-def fetch_hotel_details_text(hotel, city, r_type):
-    if not GEMINI_KEY: return {}
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    prompt = f'Get details for: "{hotel}" in "{city}". Return JSON: {{ "addr1": "Street", "addr2": "City/Zip", "phone": "Intl", "in": "3:00 PM", "out": "12:00 PM" }}'
-    try: return json.loads(model.generate_content(prompt).text.replace("```json", "").replace("```", "").strip())
-    except: return {}
-
 def fetch_hotel_data_callback():
-    """Fetches City, Room Types, and Images."""
-    selected_hotel = st.session_state.selected_hotel_key
+    load_hotel_data(st.session_state.selected_hotel_key)
+
+def load_hotel_data(selected_hotel, refresh=False):
+    """Starts fetching City, Room Types, and Images in the background; apply_hotel_lookup() picks them up as they arrive."""
     if not selected_hotel: return
     
     st.session_state.hotel_name = selected_hotel
-    
-    if GEMINI_KEY:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        try:
-            search_res = google_search(f"{selected_hotel} official site rooms accommodation")
-            snippets = "\n".join([i.get('snippet','') for i in search_res])
-            prompt = f"""Based on these search results for "{selected_hotel}":\n{snippets}\n1. Identify the City.\n2. List 3-5 official room categories.\nReturn JSON: {{ "city": "CityName", "rooms": ["Room A", "Room B"] }}"""
-            raw = model.generate_content(prompt).text
-            data = json.loads(raw.replace("```json", "").replace("```", "").strip())
-            st.session_state.city = data.get("city", "")
-            st.session_state.fetched_room_types = data.get("rooms", [])
-        except: 
-            st.session_state.city = ""
-            st.session_state.fetched_room_types = ["Standard", "Deluxe"]
-
-    base_q = f"{selected_hotel} {st.session_state.city}"
-    st.session_state.hotel_images = [
-        fetch_image(f"{base_q} building exterior architecture daytime"),
-        fetch_image(f"{base_q} hotel lobby interior design luxury"),
-        fetch_image(f"{base_q} guest room bedroom interior design")
-    ]
-
-def get_smart_images(hotel, city):
-    base_q = f"{hotel} {city}"
-    return [
-        fetch_image(f"{base_q} building exterior architecture daytime"),
-        fetch_image(f"{base_q} hotel lobby interior design luxury"),
-        fetch_image(f"{base_q} guest room bedroom interior design")
-    ]
-
-def google_search(query, num=5):
-    if not SEARCH_KEY or not SEARCH_CX: return []
-    try:
-        url = "https://www.googleapis.com/customsearch/v1"
-        params = {"q": query, "cx": SEARCH_CX, "key": SEARCH_KEY, "num": num}
-        res = requests.get(url, params=params, timeout=5)
-        if res.status_code != 200: return []
-        return res.json().get("items", [])
-    except: return []
-
-def find_hotel_options(keyword):
-    if not keyword: return []
-    results = google_search(f"{keyword} hotel official site")
-    hotels = []
-    for item in results:
-        title = item.get('title', '').split('|')[0].split('-')[0].strip()
-        if title and title not in hotels: hotels.append(title)
-    return hotels[:5]
-
-# --- ROBUST IMAGE FETCHER ---
-def fetch_image(query):
-    if not SEARCH_KEY or not SEARCH_CX: return None
-    try:
-        # Fetch 3 candidates to ensure at least one works
-        res = requests.get("https://www.googleapis.com/customsearch/v1", 
-                           params={
-                               "q": query, "cx": SEARCH_CX, "key": SEARCH_KEY, 
-                               "searchType": "image", "num": 3, 
-                               "imgSize": "large", "safe": "active"
-                           })
-        items = res.json().get("items", [])
-        
-        for item in items:
-            link = item.get("link", "")
-            # Filter out WebP (breaks PDF)
-            if ".webp" in link.lower(): continue
-            
-            try:
-                # Verify link is alive
-                r = requests.get(link, timeout=2, stream=True)
-                if r.status_code == 200:
-                    return link
-            except: continue
-            
-        return None # No valid images found
-    except: return None
-
-def get_img_reader(url):
-    if not url: return None
-    try:
-        r = requests.get(url, timeout=4)
-        if r.status_code == 200: return ImageReader(io.BytesIO(r.content))
-    except: return None
+    # Joins anyone already looking this hotel up, and drops our interest in the hotel we picked before
+    st.session_state.hotel_lookup = HOTEL_LOOKUPS.start(selected_hotel, st.session_state.city, supersedes=st.session_state.hotel_lookup, refresh=refresh)
+    st.session_state.hotel_lookup_seen = 0
+
+def apply_hotel_lookup():
+    """Copies whatever a lookup has found so far into the session; runs before any widget so city etc. can still be set."""
+    lookup = st.session_state.hotel_lookup
+    if lookup is None: return
+    progress = dict(lookup.progress)
+    if lookup.hotel == st.session_state.hotel_name and progress.get("version", 0) > st.session_state.hotel_lookup_seen:
+        st.session_state.hotel_lookup_seen = progress["version"]
+        if "city" in progress: st.session_state.city = progress["city"]
+        if "rooms" in progress: st.session_state.fetched_room_types = progress["rooms"]
+        if "images" in progress: st.session_state.hotel_images = progress["images"]
+    if not lookup.future.done(): return
+    st.session_state.hotel_lookup = None
+    try: lookup.future.result()
+    except CancelledError: pass
+    except Throttled as e: st.warning(f"⏳ {e}. Hotel details were not fully loaded, try again shortly.")
+    except Exception as e: st.warning(f"Could not load details for {lookup.hotel}: {e}")
+
+def refresh_hotel_data_callback():
+    """Drops everything cached for the current hotel and looks it up again, image searches included."""
+    hotel = st.session_state.hotel_name
+    if not hotel: return
+    HOTEL_STORE.invalidate(hotel)
+    load_hotel_data(hotel, refresh=True)
+
+apply_hotel_lookup()
+
+@st.fragment(run_every=0.5 if st.session_state.hotel_lookup else None)
+def hotel_lookup_status():
+    lookup = st.session_state.hotel_lookup
+    if lookup is None: return
+    if lookup.future.done() or lookup.progress.get("version", 0) > st.session_state.hotel_lookup_seen: st.rerun()
+    st.caption(f"⏳ Loading details for {lookup.hotel}…")
 
 # =====================================
-# 5) PDF GENERATION
-# =====================================
-
-def draw_vector_seal(c, x, y):
-    c.saveState()
-    c.setStrokeColor(BRAND_BLUE); c.setFillColor(BRAND_BLUE); c.setFillAlpha(0.9); c.setLineWidth(1.5)
-    cx, cy = x + 40, y + 40
-    c.circle(cx, cy, 40, stroke=1, fill=0)
-    c.setLineWidth(0.5); c.circle(cx, cy, 36, stroke=1, fill=0)
-    c.setFont("Helvetica-Bold", 10); c.drawCentredString(cx, cy + 4, "ODADUU")
-    c.setFont("Helvetica-Bold", 7); c.drawCentredString(cx, cy - 6, "TRAVEL DMC")
-    c.setFont("Helvetica-Bold", 6)
-    text_top = "CERTIFIED VOUCHER"; angle_start = 140
-    for i, char in enumerate(text_top):
-        angle = angle_start - (i * 10); rad = radians(angle)
-        tx = cx + 32 * cos(rad); ty = cy + 32 * sin(rad)
-        c.saveState(); c.translate(tx, ty); c.rotate(angle - 90); c.drawCentredString(0, 0, char); c.restoreState()
-    text_bot = "OFFICIAL"; angle_start = 240
-    for i, char in enumerate(text_bot):
-        angle = angle_start + (i * 12); rad = radians(angle)
-        tx = cx + 32 * cos(rad); ty = cy + 32 * sin(rad)
-        c.saveState(); c.translate(tx, ty); c.rotate(angle + 90); c.drawCentredString(0, 0, char); c.restoreState()
-    c.restoreState()
-
-def _draw_header(c, w, y_top):
-    logo_w, logo_h = 140, 55
-    try: 
-        c.drawImage(LOGO_FILE, (w - logo_w)/2, y_top - logo_h, logo_w, logo_h, mask='auto', preserveAspectRatio=True)
-    except: 
-        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 24); c.drawCentredString(w / 2, y_top - 35, "ODADUU")
-    c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(w / 2, y_top - logo_h - 20, "HOTEL CONFIRMATION VOUCHER")
-    return y_top - logo_h - 40
-
-def _draw_merged_info_box(c, x, y, w, guest_rows, hotel_rows, room_rows):
-    g_data = [["GUEST INFORMATION", ""]]; g_data.extend(guest_rows)
-    t_guest = Table(g_data, colWidths=[90, (w/2) - 100])
-    t_guest.setStyle(TableStyle([
-        ("SPAN", (0, 0), (-1, 0)), ("ALIGN", (0, 0), (-1, 0), "LEFT"),
-        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 7.5),
-        ("TEXTCOLOR", (0, 0), (-1, 0), BRAND_BLUE), ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("LEFTPADDING", (0,0), (-1,-1), 0),
-    ]))
-    h_data = [["HOTEL DETAILS", ""]]; h_data.extend(hotel_rows)
-    t_hotel = Table(h_data, colWidths=[70, (w/2) - 80])
-    t_hotel.setStyle(TableStyle([
-        ("SPAN", (0, 0), (-1, 0)), ("ALIGN", (0, 0), (-1, 0), "LEFT"),
-        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 7.5),
-        ("TEXTCOLOR", (0, 0), (-1, 0), BRAND_BLUE), ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("LEFTPADDING", (0,0), (-1,-1), 0),
-    ]))
-    r_data_formatted = [["ROOM INFORMATION", ""]] + room_rows
-    t_room = Table(r_data_formatted, colWidths=[90, w - 110])
-    t_room.setStyle(TableStyle([
-        ("SPAN", (0, 0), (-1, 0)), ("ALIGN", (0, 0), (-1, 0), "LEFT"),
-        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 7.5),
-        ("TEXTCOLOR", (0, 0), (-1, 0), BRAND_BLUE), ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("LEFTPADDING", (0,0), (-1,-1), 0),
-    ]))
-    master_data = [[t_guest, t_hotel], [t_room, ""]]
-    master_table = Table(master_data, colWidths=[w/2, w/2])
-    master_table.setStyle(TableStyle([
-        ("SPAN", (0, 1), (1, 1)), # Span Room
-        ("BOX", (0, 0), (-1, -1), 1.5, black), 
-        ("LINEBELOW", (0, 0), (1, 0), 0.5, lightgrey), 
-        ("LINEAFTER", (0, 0), (0, 0), 0.5, lightgrey),
-        ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("TOPPADDING", (0, 0), (-1, -1), 3), ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
-        ("LEFTPADDING", (0, 0), (-1, -1), 6), ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-    ]))
-    tw, th = master_table.wrapOn(c, w, 9999)
-    master_table.drawOn(c, x, y - th)
-    return y - th - 15
-
-# --- FIXED IMAGE ROW (UNIFORM 100pt, 0.75 Gap) ---
-def _draw_image_row(c, x, y, w, imgs, scale_factor=1.0):
-    valid = [im for im in imgs if im]
-    if not valid: return y
-
-    gap = 0.75 * scale_factor 
-    img_w = (w - (2 * gap)) / 3
-    img_h = 100 * scale_factor 
-    
-    for i in range(min(3, len(valid))):
-        im = valid[i]
-        curr_x = x + (i * (img_w + gap))
-        try: c.drawImage(im, curr_x, y - img_h, img_w, img_h, preserveAspectRatio=False, anchor='c')
-        except: pass
-        
-    return y - img_h - (10 * scale_factor)
-
-def _build_policy_table(w):
-    data = [
-        ["Policy", "Time / Detail"],
-        ["Standard Check-in Time:", "3:00 PM"], ["Standard Check-out Time:", "12:00 PM"],
-        ["Early Check-in/Late Out:", "Subject to availability. Request upon arrival."],
-        ["Required at Check-in:", "Passport & Credit Card/Cash Deposit."]
-    ]
-    t = Table(data, colWidths=[170, w - 170])
-    t.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), BRAND_BLUE), ("TEXTCOLOR", (0, 0), (-1, 0), white),
-        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 8.5),
-        ("GRID", (0, 0), (-1, -1), 0.5, black), ("BOX", (0, 0), (-1, -1), 1.0, black),
-        ("PADDING", (0, 0), (-1, -1), 4)
-    ]))
-    return t
-
-def _build_tnc_table(w, lead_guest, font_size=7):
-    styles = getSampleStyleSheet()
-    s = ParagraphStyle("tnc", parent=styles["Normal"], fontName="Times-Roman", fontSize=font_size, leading=font_size+1.5, textColor=black)
-    lines = [
-        "• Voucher Validity: This voucher is for the dates and services specified above. It must be presented at the hotel's front desk upon arrival.",
-        f"• Identification: The lead guest, {lead_guest}, must be present at check-in and must present valid government-issued photo identification.",
-        '• No-Show Policy: In the event of a "no-show", the hotel reserves the right to charge a fee, typically equivalent to the full cost of the stay.',
-        "• Payment/Incidental Charges: The reservation includes the room and breakfast as specified. Any other charges (e.g., mini-bar, laundry) must be settled by the guest directly.",
-        "• Occupancy: The room is confirmed for the number of guests mentioned above. Any change in occupancy must be approved by the hotel.",
-        "• Hotel Rights: The hotel reserves the right to refuse admission or request a guest to leave for inappropriate conduct.",
-        "• Liability: The hotel is not responsible for the loss or damage of personal belongings unless deposited in the hotel's safety deposit box.",
-        "• Reservation Non-Transferable: This booking is non-transferable and may not be resold.",
-        "• City Tax: City tax (if any) is not included and must be paid and settled directly at the hotel.",
-        "• Bed Type: Bed type is subject to availability and cannot be guaranteed."
-    ]
-    rows = [[Paragraph(l, s)] for l in lines]
-    t = Table(rows, colWidths=[w])
-    t.setStyle(TableStyle([
-        ("VALIGN", (0,0), (-1,-1), "TOP"), ("BOX", (0,0), (-1,-1), 1.0, black),
-        ("PADDING", (0,0), (-1,-1), 2), ("LINEBELOW", (0,0), (-1,-2), 0.25, lightgrey)
-    ]))
-    return t
-
-def generate_pdf_final(data, hotel_info, rooms_list, imgs):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    w, h = A4
-    left = 40; right = w - 40; top = h - 40; content_w = right - left
-    styles = getSampleStyleSheet()
-    addr_style = ParagraphStyle("addr", parent=styles["Normal"], fontSize=7.5, leading=9, fontName="Helvetica-Bold", textColor=black)
-    remark_style = ParagraphStyle("remark", parent=styles["Normal"], fontSize=7.5, leading=9, fontName="Helvetica-Bold", textColor=black)
-
-    for idx, room in enumerate(rooms_list):
-        if idx > 0: c.showPage()
-        
-        y = top
-        y = _draw_header(c, w, y)
-
-        guest_p = Paragraph(room["guest"], addr_style)
-        room_p = Paragraph(data["room_type"], addr_style)
-        remarks_val = data["remarks"] if data["remarks"] else "N/A"
-        remarks_p = Paragraph(remarks_val, remark_style)
-
-        pax_str = f'{room["adults"]} Adults'
-        if room["children"] > 0:
-            pax_str += f', {room["children"]} Children'
-
-        guest_rows = [
-            ["Guest Name:", guest_p],
-            ["No. of Pax:", pax_str],
-            ["Cancellation:", data["cancellation"]],
-            ["Remarks:", remarks_p]
-        ]
-        
-        addr_str = f"{hotel_info.get('addr1','')}\n{hotel_info.get('addr2','')}".strip()
-        addr_para = Paragraph(addr_str.replace('\n', '<br/>'), addr_style)
-        hotel_name_p = Paragraph(data["hotel"], addr_style)
-        hotel_rows = [
-            ["Hotel:", hotel_name_p],
-            ["Address:", addr_para],
-            ["Check-In:", data["checkin"].strftime("%d %b %Y")],
-            ["Check-Out:", data["checkout"].strftime("%d %b %Y")],
-        ]
-        
-        room_rows = [
-            ["Room Type:", room_p],
-            ["Room Size:", data["room_size"] or "N/A"],
-            ["Confirmation No.:", room["conf"]],
-            ["Meal Plan:", data["meal_plan"]],
-            ["No. of Nights:", str(data["nights"])],
-        ]
-
-        scale = 1.0
-        tnc_font = 7
-        y = _draw_merged_info_box(c, left, y, content_w, guest_rows, hotel_rows, room_rows)
-        space_left = y - MIN_CONTENT_Y
-        
-        if space_left < 320:
-            scale = 0.8
-            tnc_font = 6
-            
-        y = _draw_image_row(c, left, y, content_w, imgs, scale)
-
-        y -= 8
-        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 10.6); c.drawString(left, y, "HOTEL POLICIES"); y -= 10
-        pt = _build_policy_table(content_w)
-        _, ph = pt.wrapOn(c, content_w, 9999)
-        if y - ph < MIN_CONTENT_Y: 
-            tnc_font = 5.5 
-        pt.drawOn(c, left, y - ph); y -= (ph + 12)
-        
-        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 10); c.drawString(left, y, "TERMS & CONDITIONS"); y -= 8
-        lead_guest = room["guest"].split(',')[0] if room["guest"] else "Guest"
-        
-        if y - MIN_CONTENT_Y < 120: tnc_font = 5
-            
-        tnc = _build_tnc_table(content_w, lead_guest, tnc_font)
-        _, th = tnc.wrapOn(c, content_w, 9999)
-        tnc.drawOn(c, left, y - th)
-
-        draw_vector_seal(c, w - 130, 45)
-        c.setStrokeColor(BRAND_ORANGE); c.setLineWidth(2); c.line(0, FOOTER_LINE_Y, w, FOOTER_LINE_Y)
-        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 8)
-        c.drawString(left, 30, f"Issued by: {COMPANY_NAME}")
-        c.drawString(left, 20, f"Email: {COMPANY_EMAIL}")
-        c.drawString(left, 10, "Odaduu Japan : 1 Chome-3-12 Takadanobaba, Shinjuku, Tokyo 169-0075")
-
-    c.save(); buffer.seek(0); return buffer
-
-# =====================================
-# 6) UI LOGIC
+# 4) UI LOGIC
 # =====================================
 st.title("🌏 Odaduu Voucher Generator")
 
@@ -468,24 +124,20 @@ if st.button("🔄 Reset"):
     st.session_state["uploader_key"] = old_key + 1 # Increment to force re-render
     st.rerun()
 
-def smart_get_col(row, possibilities, default_val=""):
-    row_keys_norm = {k.strip().lower(): k for k in row.keys()}
-    for p in possibilities:
-        p_norm = p.strip().lower()
-        if p_norm in row_keys_norm:
-            val = row[row_keys_norm[p_norm]]
-            if pd.notna(val) and str(val).strip() != "":
-                return val
-    return default_val
-
 # --- PDF UPLOADER WITH DYNAMIC KEY ---
 with st.expander("📤 Upload PDF (Voucher Extraction)", expanded=True):
     dynamic_key = f"pdf_uploader_{st.session_state.get('uploader_key', 0)}"
     up_file = st.file_uploader("PDF", type="pdf", key=dynamic_key)
+    local_hits, parsed_total = pdf_parse_hit_rate()
+    if parsed_total:
+        st.caption(f"Known supplier layouts parsed locally: {local_hits}/{parsed_total} ({local_hits / parsed_total:.0%})")
     
-    if up_file and st.session_state.last_uploaded_file != up_file.name:
+    up_digest = pdf_digest(up_file.getvalue()) if up_file else None
+    if up_file and st.session_state.last_uploaded_file != up_digest:
         with st.spinner("Analyzing PDF..."):
-            parsed = extract_pdf_data(up_file)
+            try: parsed = extract_pdf_data(up_file)
+            except Throttled as e:
+                st.warning(f"⏳ {e}. The PDF will be analyzed again on your next change."); parsed = None
             if parsed:
                 st.session_state.hotel_name = parsed.get("hotel_name", "")
                 st.session_state.city = parsed.get("city", "")
@@ -512,7 +164,7 @@ with st.expander("📤 Upload PDF (Voucher Extraction)", expanded=True):
                 if st.session_state.hotel_name:
                     fetch_hotel_data_callback() 
 
-                st.session_state.last_uploaded_file = up_file.name
+                st.session_state.last_uploaded_file = up_digest
                 st.success("PDF Data Extracted! Review below in 'Bulk' mode.")
                 st.rerun()
 
@@ -524,14 +176,19 @@ with c1:
             st.warning("Please enter a hotel name or address.")
         else:
             with st.spinner("Searching..."):
-                found = find_hotel_options(q)
-                if not found:
+                try: found = find_hotel_options(q)
+                except Throttled as e:
+                    st.warning(f"⏳ {e}."); found = None
+                if found is None: pass
+                elif not found:
                     st.error("No results found.")
                 else:
                     st.session_state.found_hotels = found
                     st.session_state.selected_hotel_key = found[0]
                     fetch_hotel_data_callback() 
                     st.rerun()
+    if SEARCH_LIMITER.daily_quota:
+        st.caption(f"Custom Search calls today: {SEARCH_LIMITER.used_today()}/{SEARCH_LIMITER.daily_quota}")
     
     if st.session_state.found_hotels:
         st.selectbox(
@@ -543,57 +200,45 @@ with c1:
 
     st.text_input("Hotel", key="hotel_name")
     st.text_input("City", key="city")
+    st.button("♻️ Refresh Hotel Data", on_click=refresh_hotel_data_callback, help="Ignore cached details for this hotel and fetch them again")
+    hotel_lookup_status()
     
     mode = st.radio("Mode", ["Manual", "Bulk"], key="mode_selection")
     
     if mode == "Manual":
-        n = st.number_input("Rooms", 1, 50, key="num_rooms")
+        n = st.number_input("Rooms", 1, key="num_rooms")
         same = st.checkbox("Same Conf?", key="same_conf_check")
-        for i in range(n):
+        # Widgets exist only for the rows on screen; on_change copies each edit into the room list
+        for i, room in enumerate(manual_rooms(n)):
             c_a, c_b, c_c, c_d = st.columns([3, 2, 1, 1])
-            c_a.text_input(f"Guest {i+1}", key=f"room_{i}_guest")
+            c_a.text_input(f"Guest {i+1}", room.guest, key=f"room_{i}_guest", on_change=_sync_room, args=(i, "guest"))
             
             if i > 0 and same:
-                st.session_state[f"room_{i}_conf"] = st.session_state.get(f"room_{0}_conf", "")
-                c_b.text_input(f"Conf {i+1}", key=f"room_{i}_conf", disabled=True)
+                c_b.text_input(f"Conf {i+1}", st.session_state.rooms[0].conf, disabled=True)
             else:
-                c_b.text_input(f"Conf {i+1}", key=f"room_{i}_conf")
+                c_b.text_input(f"Conf {i+1}", room.conf, key=f"room_{i}_conf", on_change=_sync_room, args=(i, "conf"))
                 
-            c_c.number_input("Adt", 1, 10, key=f"room_{i}_adults")
-            c_d.number_input("Chd", 0, 10, key=f"room_{i}_children")
+            c_c.number_input("Adt", 1, 10, room.adults, key=f"room_{i}_adults", on_change=_sync_room, args=(i, "adults"))
+            c_d.number_input("Chd", 0, 10, room.children, key=f"room_{i}_children", on_change=_sync_room, args=(i, "children"))
             
     else:
-        f = st.file_uploader("CSV", type="csv")
+        f = st.file_uploader("CSV / Excel", type=["csv", "xlsx"])
         if f:
-            try:
-                df = pd.read_csv(f, encoding='utf-8-sig') 
-            except:
-                f.seek(0)
-                df = pd.read_csv(f, encoding='latin-1')
-            
-            processed_data = []
-            for _, row in df.iterrows():
-                g_name = smart_get_col(row, ["Guest Name", "Guests", "Guest", "Name", "Guest_Name"])
-                c_no = smart_get_col(row, ["Confirmation No", "Confirmation", "Conf", "Conf_No", "Booking Ref", "Room_No"])
-                
-                adt_raw = smart_get_col(row, ["Adults", "Adult", "adults", "ADT", "Adt"])
-                if str(adt_raw) != "":
-                    try: adt = int(adt_raw)
-                    except: adt = 2
-                else:
-                    adt = len(str(g_name).split(',')) if g_name else 2
-                
-                chd_raw = smart_get_col(row, ["Children", "Child", "children", "child", "Kids", "kids", "CHD", "Chd"])
-                try: chd = int(chd_raw) if str(chd_raw) != "" else 0
-                except: chd = 0
-                
-                processed_data.append({
-                    "Guest Name": g_name,
-                    "Confirmation No": c_no,
-                    "Adults": adt,
-                    "Children": chd
-                })
-            st.session_state.bulk_data = processed_data 
+            f_digest = hashlib.sha256(f.getvalue()).hexdigest()
+            if st.session_state.last_manifest_file != f_digest:
+                status = st.empty()
+                def _show_progress(records, issues):
+                    status.caption(f"Imported {len(records)} rows · {len(issues)} issues")
+                # Rows are published only once the whole file has been read, so a failed import leaves the table as it was
+                try:
+                    st.session_state.bulk_data, st.session_state.manifest_issues = import_manifest(f, f.name, _show_progress)
+                    st.session_state.last_manifest_file = f_digest
+                except Exception as e:
+                    st.error(f"Could not read {f.name}: {e}")
+                status.empty()
+            if st.session_state.manifest_issues:
+                with st.expander(f"⚠️ {len(st.session_state.manifest_issues)} rows need attention"):
+                    st.dataframe(pd.DataFrame(st.session_state.manifest_issues), hide_index=True, use_container_width=True)
             
         st.info("👇 PLEASE EDIT THIS TABLE: Correct any missing Adults, Children or Conf Nos here.")
         
@@ -625,49 +270,55 @@ with c2:
         d = st.number_input("Days", 3)
         pol = f"Free Cancel until {(st.session_state.checkin - timedelta(days=d)).strftime('%d %b %Y')}"
 
+    st.checkbox("One PDF per room (ZIP)", key="split_output", help="Each room's voucher as its own file, named by guest and confirmation number")
+
 if st.button("Generate Voucher", type="primary"):
-    with st.spinner("Processing..."):
-        rooms = []
-        
-        if mode == "Manual":
-            mc = st.session_state.get("room_0_conf", "")
-            for i in range(st.session_state.num_rooms):
-                if i > 0 and st.session_state.same_conf_check:
-                    c = mc
-                else:
-                    c = st.session_state.get(f"room_{i}_conf", "")
-                    
-                rooms.append({
-                    "guest": st.session_state.get(f"room_{i}_guest", ""),
-                    "conf": c,
-                    "adults": st.session_state.get(f"room_{i}_adults", 2),
-                    "children": st.session_state.get(f"room_{i}_children", 0)
-                })
+    if mode == "Manual":
+        entries = manual_rooms(st.session_state.num_rooms)
+        same_conf = entries[0].conf if st.session_state.get("same_conf_check") else None
+        rooms = [r.as_room(same_conf if i > 0 else None) for i, r in enumerate(entries)]
+    else:
+        rooms = manifest_rooms(st.session_state.bulk_data)
+    
+    if rooms:
+        # Hotel lookup, images and rendering all happen on the job runner; the page stays editable meanwhile
+        job_id = voucher_jobs().submit(
+            f"{st.session_state.hotel_name or 'Voucher'} · {len(rooms)} room{'s' if len(rooms) > 1 else ''}",
+            voucher_data(
+                st.session_state.hotel_name, st.session_state.checkin, st.session_state.checkout,
+                st.session_state.room_final, st.session_state.meal_plan, pol,
+                st.session_state.room_size, st.session_state.remarks
+            ), rooms, city=st.session_state.city, imgs=st.session_state.hotel_images, split=st.session_state.split_output)
+        st.session_state.voucher_jobs.insert(0, job_id)
+        st.toast("Voucher queued, it will appear under Vouchers when ready.")
+    else:
+        st.error("No guest data found. Please add rooms.")
+
+JOB_ACTIVE = ("queued", "running")
+
+def _jobs_active():
+    return any(j["status"] in JOB_ACTIVE for j in JOB_STORE.get_many(st.session_state.voucher_jobs))
+
+@st.fragment(run_every=2 if _jobs_active() else None)
+def voucher_jobs_panel(was_active):
+    jobs = JOB_STORE.get_many(st.session_state.voucher_jobs)
+    if not jobs: return
+    st.subheader("Vouchers")
+    for job in jobs:
+        c_l, c_r = st.columns([3, 1])
+        c_l.write(job["label"])
+        if job["status"] == "done" and job["path"] and os.path.exists(job["path"]):
+            ext = os.path.splitext(job["path"])[1]
+            with open(job["path"], "rb") as fh:
+                c_r.download_button("Download", fh, f"Voucher_{file_slug(job['label'])}{ext}", "application/zip" if ext == ".zip" else "application/pdf", key=f"dl_{job['id']}")
+            if job["error"]: c_l.warning(job["error"])
+        elif job["status"] == "failed":
+            c_r.error(job["error"] or "Failed")
+        elif job["status"] == "done":
+            c_r.warning("Expired")
         else:
-            if st.session_state.bulk_data:
-                for r in st.session_state.bulk_data:
-                    rooms.append({
-                        "guest": str(r.get("Guest Name", "")),
-                        "conf": str(r.get("Confirmation No", "")),
-                        "adults": int(r.get("Adults", 2)),
-                        "children": int(r.get("Children", 0))
-                    })
-        
-        if rooms:
-            info = fetch_hotel_details_text(st.session_state.hotel_name, st.session_state.city, st.session_state.room_final)
-            imgs = st.session_state.hotel_images if any(st.session_state.hotel_images) else get_smart_images(st.session_state.hotel_name, st.session_state.city)
-            
-            n_nights = (st.session_state.checkout - st.session_state.checkin).days
-            if n_nights < 1: n_nights = 1
+            c_l.progress(job["done"] / max(job["total"], 1), text=f"{job['done']}/{job['total']} pages" if job["status"] == "running" else "Queued")
+    # Stop polling once everything this session queued has finished
+    if was_active and not any(j["status"] in JOB_ACTIVE for j in jobs): st.rerun()
 
-            pdf = generate_pdf_final({
-                "hotel": st.session_state.hotel_name, "checkin": st.session_state.checkin, "checkout": st.session_state.checkout,
-                "room_type": st.session_state.room_final, 
-                "meal_plan": st.session_state.meal_plan,
-                "cancellation": pol, "nights": n_nights, "room_size": st.session_state.room_size, "remarks": st.session_state.remarks
-            }, info, rooms, imgs)
-            
-            st.success("Done!")
-            st.download_button("Download", pdf, "Voucher.pdf", "application/pdf")
-        else:
-            st.error("No guest data found. Please add rooms.")
+voucher_jobs_panel(_jobs_active())
@@ -0,0 +1,195 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pandas as pd
+import pypdf
+import pytest
+
+import voucher_engine as ve
+
+
+def _voucher(tag, n):
+    data = ve.voucher_data(f"Hotel {tag}", date(2026, 1, 1), date(2026, 1, 3), "Standard Double")
+    rooms = [{"guest": f"{tag} Guest {i}, Other", "conf": f"{tag}{i}", "adults": 2, "children": 0} for i in range(n)]
+    return data, {"addr1": "1-19-1 Kabukicho", "addr2": "Tokyo"}, rooms
+
+
+def test_concurrent_renders_keep_their_own_pages(monkeypatch):
+    monkeypatch.setattr(ve, "PAGE_CACHE_MAX_BYTES", 0)
+
+    def render(tag):
+        data, info, rooms = _voucher(tag, 12)
+        pdf = ve.generate_pdf_final(data, info, rooms, [None] * 3, parallel=False)
+        return tag, [page.extract_text() for page in pypdf.PdfReader(pdf).pages]
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(render, ["Alpha", "Bravo", "Charlie", "Delta"] * 2))
+    for tag, pages in results:
+        assert len(pages) == 12
+        for i, text in enumerate(pages):
+            assert f"{tag} Guest {i}" in text and f"The lead guest, {tag} Guest {i}, must be present" in text.replace("\n", " ")
+
+
+def test_merge_voucher_parts_keeps_rooms_sharing_a_confirmation_number():
+    room = lambda guest, conf: {"guest_name": guest, "confirmation_no": conf}
+    merged = ve.merge_voucher_parts([
+        {"hotel_name": "Hotel A", "rooms": [room("Ann Lee", "GRP1"), room("Bo Kim", "GRP1"), room("Cy Ito", "GRP1")]},
+        {"hotel_name": "", "rooms": [room("bo kim ", "GRP1"), room("Di Ono", "GRP1")]},
+    ])
+    assert merged["hotel_name"] == "Hotel A"
+    assert [r["guest_name"] for r in merged["rooms"]] == ["Ann Lee", "Bo Kim", "Cy Ito", "Di Ono"]
+
+
+def test_merge_voucher_parts_keeps_unnamed_group_rooms_across_chunks():
+    tba = {"guest_name": "TBA", "confirmation_no": "GRP77"}
+    merged = ve.merge_voucher_parts([{"rooms": [dict(tba) for _ in range(20)]}, {"rooms": [dict(tba) for _ in range(20)]}])
+    assert len(merged["rooms"]) == 40
+    # ...even when a later chunk has a single TBA room left
+    merged = ve.merge_voucher_parts([{"rooms": [dict(tba), dict(tba)]}, {"rooms": [dict(tba)]}])
+    assert len(merged["rooms"]) == 3
+
+
+def test_own_voucher_layout_round_trips_and_generic_text_falls_through(monkeypatch):
+    monkeypatch.setattr(ve, "PAGE_CACHE_MAX_BYTES", 0)
+    data, info, rooms = _voucher("Echo", 3)
+    rooms[1]["conf"], rooms[2]["children"] = "", 1
+    pdf = ve.generate_pdf_final(data, info, rooms, [None] * 3, parallel=False).read()
+    layout, parsed = ve.parse_known_layout("\n".join(ve.extract_pdf_pages(pdf)))
+    assert layout == "odaduu_voucher" and parsed["hotel_name"] == "Hotel Echo"
+    assert [(r["guest_name"], r["confirmation_no"], r["adults"], r["children"]) for r in parsed["rooms"]] == [
+        ("Echo Guest 0, Other", "Echo0", 2, 0), ("Echo Guest 1, Other", "", 2, 0), ("Echo Guest 2, Other", "Echo2", 2, 1)]
+    assert ve.parse_known_layout("Hotel: X\nCheck-in: 2026-01-01\nCheck-out: 2026-01-02\nConfirmation: 1\nGuest Name: A\nAdults: 2") == (None, None)
+
+
+def test_room_pdf_names_are_unique():
+    rooms = [{"guest": g, "conf": c} for g, c in [("A", "1"), ("A", "1"), ("A_1", "2"), ("A", "1_2"), ("", "")]]
+    names = ve.room_pdf_names(rooms)
+    assert names[:2] == ["A_1.pdf", "A_1_2.pdf"] and names[-1] == "room5.pdf"
+    assert len({n.lower() for n in names}) == len(names)
+
+
+def test_hotel_index_picks_up_own_and_external_additions(tmp_path):
+    path = str(tmp_path / "issued.sqlite3")
+    index, other = ve.HotelIndex(path), ve.HotelIndex(path)
+    index.add("Hotel Gracery Shinjuku", "Tokyo")
+    assert index.search("gracery shinjuku")[0][1:] == ("Hotel Gracery Shinjuku", "Tokyo")
+    index.add("Cross Hotel Osaka", "Osaka")
+    other.add("Kyoto Tower Hotel", "Kyoto")
+    assert index.search("cross hotel osaka")[0][1] == "Cross Hotel Osaka"
+    assert index.search("kyoto tower")[0][1:] == ("Kyoto Tower Hotel", "Kyoto")
+
+
+def test_throttled_lookups_render_the_job_with_a_warning(tmp_path, monkeypatch):
+    def throttled(*args):
+        raise ve.Throttled("Custom Search", "daily quota used up", 3600)
+    monkeypatch.setattr(ve, "fetch_hotel_details_text", throttled)
+    monkeypatch.setattr(ve, "get_smart_images", throttled)
+    monkeypatch.setattr(ve, "PAGE_CACHE_MAX_BYTES", 0)
+    monkeypatch.setattr(ve, "HOTEL_INDEX", ve.HotelIndex(str(tmp_path / "issued.sqlite3")))
+    store = ve.JobStore(str(tmp_path / "jobs.sqlite3"))
+    jobs = ve.VoucherJobs(store, str(tmp_path / "out"), 1, 3600)
+    data, _, rooms = _voucher("Foxtrot", 2)
+    job_id = jobs.submit("Foxtrot", data, rooms)
+    jobs.pool.shutdown(wait=True)
+    job = store.get_many([job_id])[0]
+    assert job["status"] == "done" and len(pypdf.PdfReader(job["path"]).pages) == 2
+    assert "no hotel details" in job["error"] and "no hotel images" in job["error"]
+
+
+def _manifest(rows):
+    df = pd.DataFrame(rows, columns=["Guest Name", "Confirmation No", "Adults", "Children"], dtype=object)
+    return df, ve.resolve_manifest_columns(df.columns)
+
+
+def test_normalize_manifest_defaults_unusable_counts():
+    df, columns = _manifest([
+        ["Ann Lee", "C1", "3", "1"],
+        ["Bo Kim, Cy Ito", "C2", None, None],
+        ["Di Ono", "C3", "inf", "-1"],
+        ["Ed Abe", "C4", "1e30", "nan"],
+        ["Fay Ota", "C5", "two", "1.0"],
+    ])
+    records = ve.normalize_manifest(df, columns)
+    assert [(r["Adults"], r["Children"]) for r in records] == [(3, 1), (2, 0), (2, 0), (2, 0), (2, 1)]
+    assert records[1] == {"Guest Name": "Bo Kim, Cy Ito", "Confirmation No": "C2", "Adults": 2, "Children": 0}
+
+
+def test_validate_manifest_reports_rows_by_spreadsheet_number():
+    df, columns = _manifest([
+        ["Ann Lee", "C1", "2", "0"],
+        ["", "", None, None],
+        ["Di Ono", "C3", "inf", "12"],
+    ])
+    issues = ve.validate_manifest(df, columns)
+    assert [(i["Row"], i["Issue"]) for i in issues] == [
+        (3, "Missing confirmation number"),
+        (3, "No adults or guest name (defaulted to 2 adults)"),
+        (4, "Adults is not a valid count (defaulted to 2)"),
+        (4, f"Children outside {ve.CHILDREN_RANGE[0]}-{ve.CHILDREN_RANGE[1]}"),
+    ]
+
+
+def test_import_manifest_rereads_late_latin1_bytes():
+    rows = "".join(f"Guest {i},C{i},2,0\n" for i in range(8000))
+    data = ("Guest Name,Confirmation No,Adults,Children\n" + rows + "José Núñez,CX,1,0\n").encode("latin-1")
+    assert len(data) > ve.MANIFEST_SNIFF_BYTES
+    records, issues = ve.import_manifest(io.BytesIO(data), "late.csv", chunk_rows=1000)
+    assert len(records) == 8001 and records[-1]["Guest Name"] == "José Núñez" and not issues
+
+
+def test_import_manifest_xlsx_with_repeated_headers():
+    from openpyxl import Workbook
+    wb = Workbook()
+    wb.active.append(["Guest Name", "Confirmation No", "Adults", "Adults", "Children"])
+    wb.active.append(["Ann Lee", "C1", 3, 9, 1])
+    buf = io.BytesIO(); wb.save(buf); buf.seek(0)
+    records, _ = ve.import_manifest(buf, "dup.xlsx")
+    assert records == [{"Guest Name": "Ann Lee", "Confirmation No": "C1", "Adults": 3, "Children": 1}]
+
+
+def test_hotel_details_found_under_a_different_city(tmp_path, monkeypatch):
+    store = ve.HotelStore(str(tmp_path / "hotels.sqlite3"), 3600)
+    store.update("Hotel Gracery Shinjuku", "Shinjuku City", {"addr1": "1-19-1 Kabukicho", "addr2": "Tokyo", "phone": "+81"})
+    monkeypatch.setattr(ve, "HOTEL_STORE", store)
+    monkeypatch.setattr(ve, "enrich_hotel", lambda *args: pytest.fail("looked the hotel up again"))
+    assert ve.fetch_hotel_details_text("Hotel Gracery Shinjuku", "Tokyo", "Double")["addr1"] == "1-19-1 Kabukicho"
+    assert ve.fetch_hotel_details_text("Hotel Gracery Shinjuku", "", "Double")["phone"] == "+81"
+
+
+def test_find_hotel_options_searches_the_web_for_partial_names(tmp_path, monkeypatch):
+    index = ve.HotelIndex(str(tmp_path / "issued.sqlite3"))
+    index.add("Hotel Gracery Shinjuku", "Tokyo")
+    monkeypatch.setattr(ve, "HOTEL_INDEX", index)
+    searches = []
+    def google_search(query, num=5):
+        searches.append(query)
+        return [{"title": "Hotel Gracery Kyoto Sanjo | Official Site"}, {"title": "Hotel Gracery Shinjuku - Official"}]
+    monkeypatch.setattr(ve, "google_search", google_search)
+    assert ve.find_hotel_options("Hotel Gracery") == ["Hotel Gracery Shinjuku", "Hotel Gracery Kyoto Sanjo"]
+    assert ve.find_hotel_options("hotel gracery shinjuku") == ["Hotel Gracery Shinjuku"] and len(searches) == 1
+
+class _Res:
+    def __init__(self, status, body=None):
+        self.status_code, self.headers, self.text, self._body = status, {}, "", body
+    def json(self): return self._body
+
+def test_search_get_retries_through_the_limiter(monkeypatch):
+    limiter = ve.ApiLimiter("Custom Search", 1000, 10, 0)
+    acquired = []
+    monkeypatch.setattr(limiter, "acquire", lambda: acquired.append(1))
+    monkeypatch.setattr(ve, "SEARCH_LIMITER", limiter)
+    monkeypatch.setattr(ve.time, "sleep", lambda s: None)
+    replies = [_Res(503), _Res(429), _Res(200, {"items": []})]
+    monkeypatch.setattr(ve, "http_get", lambda *args, **kw: replies.pop(0))
+    assert ve.search_get({"q": "retry me"}) == {"items": []} and len(acquired) == 3
+    replies[:] = [_Res(429)] * (ve.HTTP_RETRIES + 1)
+    with pytest.raises(ve.Throttled): ve.search_get({"q": "still busy"})
+    assert len(acquired) == 3 + ve.HTTP_RETRIES + 1
+
+def test_room_chunks_survive_an_inserted_room():
+    rooms = [{"guest": f"Guest {i}", "conf": f"C{i:04d}", "adults": 2, "children": 0} for i in range(300)]
+    before = ve._room_chunks(rooms)
+    assert len(before) > 3 and [r for chunk in before for r in chunk] == rooms
+    after = ve._room_chunks(rooms[:150] + [{"guest": "Late Guest", "conf": "X1", "adults": 1, "children": 0}] + rooms[150:])
+    assert len([chunk for chunk in after if chunk not in before]) <= 2
@@ -0,0 +1,121 @@
+"""Headless batch voucher rendering: a manifest in, one PDF per booking (or per group) out.
+
+    python voucher_cli.py manifest.csv --hotel "Hotel Gracery Shinjuku" --city Tokyo \
+        --checkin 2026-11-02 --checkout 2026-11-05 --room-type "Standard Double" --out vouchers/
+
+The manifest is a CSV/XLSX with the same columns as the app's Bulk mode, or a JSON list. JSON entries
+with a "rooms" list are groups that may override any voucher field (hotel, checkin, ...); plain JSON
+entries are rooms, like CSV rows. --hotel-json supplies the voucher fields from a file, plus optional
+"info" (addr1, addr2, phone, in, out) and "images" to skip enrichment; command-line flags win.
+With --split each output is instead a ZIP holding one PDF per room, named by guest and confirmation number.
+
+API keys come from GEMINI_API_KEY / SEARCH_API_KEY / SEARCH_ENGINE_ID.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import as_completed
+
+import pandas as pd
+
+from voucher_engine import (
+    RENDER_WORKERS, parse_smart_date, import_manifest, normalize_manifest, fetch_hotel_details_text,
+    hotel_profile, prepare_images, voucher_data, manifest_rooms, generate_pdf_final, generate_voucher_zip, file_slug, unique_file_names, process_pool, HOTEL_INDEX, HTTP_METRICS, Throttled,
+)
+
+VOUCHER_FIELDS = ("hotel", "city", "checkin", "checkout", "room_type", "meal_plan", "cancellation", "room_size", "remarks")
+
+def load_bookings(path, per):
+    """Returns [(label, overrides, records)]: one entry per output PDF, records in normalize_manifest form."""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as fh: items = json.load(fh)
+        if isinstance(items, dict): items = items.get("bookings", [items])
+        groups = [(g.get("file") or f"group{i+1}", {k: g[k] for k in VOUCHER_FIELDS if g.get(k)}, normalize_manifest(pd.DataFrame(g["rooms"])))
+                  for i, g in enumerate(items) if g.get("rooms")]
+        rows = [r for r in items if not r.get("rooms")]
+        records = normalize_manifest(pd.DataFrame(rows)) if rows else []
+    else:
+        with open(path, "rb") as fh: records, issues = import_manifest(fh, path)
+        for issue in issues: print(f"{path}:{issue['Row']}: {issue['Issue']}", file=sys.stderr)
+        groups = []
+
+    if records and per == "group":
+        groups.append((os.path.splitext(os.path.basename(path))[0], {}, records))
+    elif records:
+        by_conf = {}
+        for i, r in enumerate(records): by_conf.setdefault(str(r["Confirmation No"]).strip() or f"row{i+1}", []).append(r)
+        groups.extend((conf, {}, recs) for conf, recs in by_conf.items())
+    return groups
+
+def _hotel_assets(hotel, city, room_type, meta, cache):
+    """Hotel info and prepared image bytes, resolved once per hotel in the parent so workers stay offline."""
+    key = (hotel, city)
+    if key not in cache:
+        info = meta.get("info") or fetch_hotel_details_text(hotel, city, room_type)
+        images = meta.get("images") or hotel_profile(hotel, city)[2]
+        cache[key] = (info, prepare_images(images))
+    return cache[key]
+
+def _render_job(data, info, rooms, imgs, path):
+    render = generate_voucher_zip if path.endswith(".zip") else generate_pdf_final
+    render(data, info, rooms, imgs, out=path + ".tmp", parallel=False)
+    os.replace(path + ".tmp", path)
+    return path
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Render hotel vouchers from a booking manifest without the Streamlit UI.")
+    ap.add_argument("manifest", help="CSV, XLSX or JSON manifest")
+    ap.add_argument("--out", default="vouchers", help="output directory (default: vouchers)")
+    ap.add_argument("--per", choices=["booking", "group"], default="booking",
+                    help="one PDF per confirmation number, or one for all manifest rows (JSON groups are always one PDF each)")
+    ap.add_argument("--split", action="store_true", help="write a ZIP of one PDF per room for each output instead of one combined PDF")
+    ap.add_argument("--hotel-json", help="JSON file with default voucher fields, and optional info/images")
+    for name in VOUCHER_FIELDS: ap.add_argument(f"--{name.replace('_', '-')}", dest=name)
+    ap.add_argument("--workers", type=int, default=RENDER_WORKERS, help="render processes (default: ODADUU_RENDER_WORKERS or CPU count)")
+    args = ap.parse_args(argv)
+
+    meta = {}
+    if args.hotel_json:
+        with open(args.hotel_json, encoding="utf-8") as fh: meta = json.load(fh)
+    defaults = {"meal_plan": "Breakfast Only", "cancellation": "Non-Refundable", "room_size": "", "remarks": "", "city": ""}
+    defaults.update({k: meta[k] for k in VOUCHER_FIELDS if meta.get(k)})
+    defaults.update({k: getattr(args, k) for k in VOUCHER_FIELDS if getattr(args, k)})
+
+    groups = load_bookings(args.manifest, args.per)
+    if not groups: ap.error(f"no bookings found in {args.manifest}")
+    os.makedirs(args.out, exist_ok=True)
+
+    jobs, assets = [], {}
+    for label, overrides, records in groups:
+        f = {**defaults, **overrides}
+        checkin, checkout = parse_smart_date(str(f.get("checkin", ""))), parse_smart_date(str(f.get("checkout", "")))
+        if not f.get("hotel") or not checkin or not checkout:
+            print(f"{label}: skipped, needs hotel, checkin and checkout", file=sys.stderr); continue
+        room_type = f.get("room_type", "")
+        try: info, imgs = _hotel_assets(f["hotel"], f["city"], room_type, meta if f["hotel"] == meta.get("hotel") else {}, assets)
+        except Throttled as e:
+            print(f"{label}: skipped, {e}", file=sys.stderr); continue
+        data = voucher_data(f["hotel"], checkin, checkout, room_type, f["meal_plan"], f["cancellation"], f["room_size"], f["remarks"])
+        jobs.append((data, info, manifest_rooms(records), imgs, f"{file_slug(f['hotel'])}_{file_slug(label)}", f["city"]))
+
+    # Labels that slug alike ("ABC-1" / "ABC 1", repeated JSON "file" names) must not share an output file
+    names = unique_file_names([job[4] for job in jobs], ".zip" if args.split else ".pdf")
+    jobs = [(*job[:4], os.path.join(args.out, name), job[5]) for job, name in zip(jobs, names)]
+
+    failed = len(groups) - len(jobs)
+    with process_pool(max(1, min(args.workers, len(jobs) or 1))) as pool:
+        futures = {pool.submit(_render_job, *job[:5]): job for job in jobs}
+        for done, fut in enumerate(as_completed(futures), 1):
+            data, *_, path, city = futures[fut]
+            try:
+                print(f"[{done}/{len(jobs)}] {fut.result()}")
+                HOTEL_INDEX.add(data["hotel"], city)
+            except Exception as e:
+                failed += 1; print(f"[{done}/{len(jobs)}] {path} failed: {e}", file=sys.stderr)
+    for host, m in HTTP_METRICS.snapshot().items():
+        print(f"http {host}: {m['requests']} requests, {m['errors']} errors, p50 {m['p50_ms']} ms, p95 {m['p95_ms']} ms", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
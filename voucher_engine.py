@@ -0,0 +1,1877 @@
+"""Voucher engine: manifest parsing, hotel enrichment and PDF rendering, importable without Streamlit.
+
+Keys come from the GEMINI_API_KEY / SEARCH_API_KEY / SEARCH_ENGINE_ID environment variables, or configure().
+"""
+import google.generativeai as genai
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from reportlab.lib.colors import Color, lightgrey, black, white
+from reportlab.platypus import Table, TableStyle, Paragraph
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.utils import ImageReader
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+import io
+import pandas as pd
+import pypdf
+import re
+import json
+import os
+import time
+import hashlib
+import threading
+import tempfile
+import zipfile
+from dataclasses import dataclass, field
+import sqlite3
+from contextlib import closing
+import multiprocessing
+import uuid
+from concurrent.futures import Future, CancelledError, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import repeat
+from functools import lru_cache
+from collections import Counter, deque
+import random
+from urllib.parse import urlsplit
+from math import sin, cos, radians
+import codecs
+from PIL import Image, ImageOps
+from openpyxl import load_workbook
+
+
+# =====================================
+# 1) CONFIG & BRANDING
+# =====================================
+
+BRAND_BLUE = Color(0.05, 0.20, 0.40)
+BRAND_ORANGE = Color(0.97255, 0.29804, 0.0) 
+SEAL_TEXT_COLOR = Color(0.145, 0.28, 0.46)
+COMPANY_NAME = "Odaduu Travel DMC"
+COMPANY_EMAIL = "aashwin@odaduu.jp"
+LOGO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.png")
+
+FOOTER_LINE_Y = 40
+FOOTER_RESERVED_HEIGHT = 110
+MIN_CONTENT_Y = FOOTER_LINE_Y + FOOTER_RESERVED_HEIGHT 
+
+CACHE_DIR = os.environ.get("ODADUU_CACHE_DIR", ".odaduu_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("ODADUU_IMAGE_CACHE_MB", "256")) * 1024 * 1024
+IMAGE_CACHE_TTL = int(os.environ.get("ODADUU_IMAGE_CACHE_DAYS", "30")) * 86400
+PDF_CACHE_MAX_BYTES = int(os.environ.get("ODADUU_PDF_CACHE_MB", "32")) * 1024 * 1024
+PDF_CACHE_TTL = int(os.environ.get("ODADUU_PDF_CACHE_DAYS", "90")) * 86400
+
+HOTEL_CACHE_TTL = int(os.environ.get("ODADUU_HOTEL_CACHE_DAYS", "90")) * 86400
+# Outbound HTTP: (connect, read) timeout, pooled connections per host, retries on 429/5xx, and the
+# longest Retry-After (seconds) a retry will wait for
+HTTP_TIMEOUT = (3.05, 5)
+HTTP_POOL_PER_HOST = 16
+HTTP_RETRIES = 2
+HTTP_RETRY_AFTER_MAX = 5.0
+
+# API rate limits: sustained calls/second, burst size, calls/day (0 = unlimited; Google resets at midnight Pacific),
+# and how long a caller may wait for a token before getting Throttled
+SEARCH_QPS = float(os.environ.get("ODADUU_SEARCH_QPS", "5"))
+SEARCH_BURST = int(os.environ.get("ODADUU_SEARCH_BURST", "10"))
+SEARCH_DAILY_QUOTA = int(os.environ.get("ODADUU_SEARCH_DAILY", "10000"))
+GEMINI_QPS = float(os.environ.get("ODADUU_GEMINI_QPS", "2"))
+GEMINI_BURST = int(os.environ.get("ODADUU_GEMINI_BURST", "4"))
+GEMINI_DAILY_QUOTA = int(os.environ.get("ODADUU_GEMINI_DAILY", "0"))
+RATE_LIMIT_WAIT = 2.0
+# Concurrent hotel lookups (store / Gemini enrichment / image search) started from the UI
+HOTEL_LOOKUP_WORKERS = 4
+QUOTA_TZ = ZoneInfo("America/Los_Angeles")
+
+# Trigram similarity (Jaccard) between a search and an issued hotel's name: issued hotels above
+# HOTEL_MATCH_SHOW are listed ahead of Google's results, and one above HOTEL_MATCH_MIN skips Google
+HOTEL_MATCH_MIN = 0.75
+HOTEL_MATCH_SHOW = 0.3
+
+# Vouchers are rendered and cached in chunks of about RENDER_CHUNK_ROOMS rooms (at most RENDER_CHUNK_MAX), cut where a
+# room's content hash says so rather than by position; several missing chunks render across a process pool.
+# Bump RENDER_VERSION whenever the page layout changes so cached chunks are not reused.
+RENDER_CHUNK_ROOMS = 25
+RENDER_CHUNK_MAX = 100
+RENDER_VERSION = 1
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("ODADUU_PAGE_CACHE_MB", "128")) * 1024 * 1024
+PAGE_CACHE_TTL = int(os.environ.get("ODADUU_PAGE_CACHE_DAYS", "7")) * 86400
+RENDER_WORKERS = int(os.environ.get("ODADUU_RENDER_WORKERS", os.cpu_count() or 1))
+
+# Supplier PDFs: pages per extraction worker, and characters of text per Gemini request
+PDF_EXTRACT_MIN_PAGES = 8
+PDF_CHUNK_CHARS = 25000
+# Part of the parsed-PDF cache key: bump it when parsing changes so stale parses are not served
+PDF_PARSE_VERSION = 2
+
+# Finished PDFs larger than this are spooled to a temp file instead of held in memory
+PDF_SPOOL_MAX_BYTES = int(os.environ.get("ODADUU_PDF_SPOOL_MB", "4")) * 1024 * 1024
+
+# Voucher image row: three slots across the content width, 100pt high (see _draw_image_row)
+IMAGE_SLOT_PT = ((A4[0] - 80 - 1.5) / 3, 100)
+IMAGE_DPI = 150
+IMAGE_JPEG_QUALITY = 80
+
+# Bulk manifests: rows per import chunk, bytes sniffed for encoding, accepted room occupancy, and the
+# largest Adults/Children value read as a count at all (anything else is treated as unparseable)
+MANIFEST_CHUNK_ROWS = 10000
+MANIFEST_SNIFF_BYTES = 64 * 1024
+ADULTS_RANGE = (1, 10)
+CHILDREN_RANGE = (0, 10)
+MANIFEST_MAX_COUNT = 999
+
+# Background voucher jobs: concurrent jobs, and how long finished PDFs stay downloadable
+JOB_WORKERS = int(os.environ.get("ODADUU_JOB_WORKERS", "2"))
+JOB_TTL = int(os.environ.get("ODADUU_JOB_DAYS", "7")) * 86400
+
+GEMINI_KEY = None
+SEARCH_KEY = None
+SEARCH_CX = None
+
+def configure(gemini_key=None, search_key=None, search_cx=None):
+    """Sets the API keys; any left out fall back to GEMINI_API_KEY / SEARCH_API_KEY / SEARCH_ENGINE_ID in the environment."""
+    global GEMINI_KEY, SEARCH_KEY, SEARCH_CX
+    GEMINI_KEY = gemini_key or os.environ.get("GEMINI_API_KEY")
+    SEARCH_KEY = search_key or os.environ.get("SEARCH_API_KEY")
+    SEARCH_CX = search_cx or os.environ.get("SEARCH_ENGINE_ID")
+    if GEMINI_KEY: genai.configure(api_key=GEMINI_KEY)
+
+configure()
+
+# =====================================
+# 2) HELPER FUNCTIONS
+# =====================================
+
+def parse_smart_date(date_str):
+    if not date_str: return None
+    clean_str = date_str.strip()
+    clean_str = re.sub(r'\bSept\b', 'Sep', clean_str, flags=re.IGNORECASE)
+    clean_str = re.sub(r'\bSeptember\b', 'Sep', clean_str, flags=re.IGNORECASE)
+    formats = ["%d %b %Y", "%Y-%m-%d", "%d %B %Y"]
+    for fmt in formats:
+        try: return datetime.strptime(clean_str, fmt).date()
+        except ValueError: continue
+    return None
+
+def clean_extracted_text(text):
+    if not isinstance(text, str): return str(text)
+    return text.strip().replace("\n", " ").replace("  ", " ")
+
+def clean_room_type_string(raw_type):
+    if not isinstance(raw_type, str): return str(raw_type)
+    if raw_type.strip().startswith(('{', '[')) and raw_type.strip().endswith(('}', ']')):
+        try:
+            temp_data = json.loads(raw_type)
+            if isinstance(temp_data, dict): raw_type = list(temp_data.values())[0]
+            elif isinstance(temp_data, list) and temp_data: raw_type = temp_data[0]
+        except json.JSONDecodeError: pass
+    return str(raw_type).strip().strip('\'"{}[] ')
+
+MANIFEST_ALIASES = {
+    "Guest Name": ["Guest Name", "Guests", "Guest", "Name", "Guest_Name"],
+    "Confirmation No": ["Confirmation No", "Confirmation", "Conf", "Conf_No", "Booking Ref", "Room_No"],
+    "Adults": ["Adults", "Adult", "adults", "ADT", "Adt"],
+    "Children": ["Children", "Child", "children", "child", "Kids", "kids", "CHD", "Chd"],
+}
+
+def resolve_manifest_columns(columns):
+    """Maps each canonical manifest field to the file's matching columns, in alias priority order."""
+    by_norm = {str(col).strip().lower(): col for col in columns}
+    resolved = {}
+    for field_name, aliases in MANIFEST_ALIASES.items():
+        matches = [by_norm[a.strip().lower()] for a in aliases if a.strip().lower() in by_norm]
+        resolved[field_name] = list(dict.fromkeys(matches))
+    return resolved
+
+def _first_filled(df, cols):
+    """Per row, the value of the first column in `cols` that is not blank (NA where all are)."""
+    out = pd.Series(pd.NA, index=df.index, dtype="object")
+    for col in cols:
+        vals = df[col]
+        filled = vals.notna() & (vals.astype(str).str.strip() != "")
+        out = out.where(out.notna(), vals.where(filled))
+    return out
+
+def _manifest_count(raw):
+    """pd.to_numeric of a column, with NaN for anything that is not a finite count from 0 to MANIFEST_MAX_COUNT."""
+    num = pd.to_numeric(raw, errors="coerce")
+    return num.where(num.between(0, MANIFEST_MAX_COUNT))
+
+def normalize_manifest(df, columns=None):
+    """Turns a bulk manifest DataFrame into bulk_data records in one vectorized pass.
+
+    Adults/Children are coerced with _manifest_count; missing adults fall back to the number of
+    comma-separated guest names (2 when there is no name), unparseable adults to 2, children to 0.
+    """
+    columns = columns or resolve_manifest_columns(df.columns)
+    guest = _first_filled(df, columns["Guest Name"])
+    adults_raw = _first_filled(df, columns["Adults"])
+    guest_count = guest.astype("string").str.count(",").add(1).fillna(2)
+    adults = _manifest_count(adults_raw).fillna(2).where(adults_raw.notna(), guest_count)
+    children = _manifest_count(_first_filled(df, columns["Children"])).fillna(0)
+    return pd.DataFrame({
+        "Guest Name": guest.fillna(""),
+        "Confirmation No": _first_filled(df, columns["Confirmation No"]).fillna(""),
+        "Adults": adults.astype(int),
+        "Children": children.astype(int),
+    }).to_dict("records")
+
+def validate_manifest(df, columns, first_row=2):
+    """Lists problems per row as {"Row", "Issue"} dicts; rows are numbered `first_row` + df index."""
+    def _num(cols):
+        raw = _first_filled(df, cols)
+        return raw, _manifest_count(raw)
+    adt_raw, adt = _num(columns["Adults"])
+    chd_raw, chd = _num(columns["Children"])
+    checks = [
+        (_first_filled(df, columns["Confirmation No"]).isna(), "Missing confirmation number"),
+        (adt_raw.isna() & _first_filled(df, columns["Guest Name"]).isna(), "No adults or guest name (defaulted to 2 adults)"),
+        (adt_raw.notna() & adt.isna(), "Adults is not a valid count (defaulted to 2)"),
+        (adt.notna() & ~adt.between(*ADULTS_RANGE), f"Adults outside {ADULTS_RANGE[0]}-{ADULTS_RANGE[1]}"),
+        (chd_raw.notna() & chd.isna(), "Children is not a valid count (defaulted to 0)"),
+        (chd.notna() & ~chd.between(*CHILDREN_RANGE), f"Children outside {CHILDREN_RANGE[0]}-{CHILDREN_RANGE[1]}"),
+    ]
+    issues = [{"Row": int(i) + first_row, "Issue": msg} for mask, msg in checks for i in mask[mask].index]
+    return sorted(issues, key=lambda x: x["Row"])
+
+def sniff_encoding(f, sample_size=MANIFEST_SNIFF_BYTES):
+    """Picks utf-8-sig or latin-1 from the head of the file, leaving `f` rewound."""
+    sample = f.read(sample_size); f.seek(0)
+    try: codecs.getincrementaldecoder("utf-8-sig")().decode(sample, final=False)
+    except UnicodeDecodeError: return "latin-1"
+    return "utf-8-sig"
+
+def _cell_text(v):
+    if v is None: return None
+    if isinstance(v, float) and v.is_integer(): v = int(v)
+    return str(v)
+
+def _iter_xlsx_chunks(f, chunk_rows):
+    wb = load_workbook(f, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header, seen = [], Counter()
+        for i, h in enumerate(next(rows, ())):
+            # Repeated headers get .1, .2... suffixes, as pandas gives them in the CSV path
+            h = _cell_text(h) or f"Column {i+1}"
+            header.append(f"{h}.{seen[h]}" if seen[h] else h); seen[h] += 1
+        batch, start = [], 0
+        for row in rows:
+            batch.append([_cell_text(v) for v in row[:len(header)]])
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=header, index=range(start, start + len(batch)))
+                start += len(batch); batch = []
+        if batch: yield pd.DataFrame(batch, columns=header, index=range(start, start + len(batch)))
+    finally:
+        wb.close()
+
+def iter_manifest_chunks(f, name, chunk_rows=MANIFEST_CHUNK_ROWS, encoding=None):
+    """Yields a CSV/XLSX manifest as string-typed DataFrames of at most `chunk_rows` rows, indexed by data row.
+
+    CSV encoding is sniffed from the head of the file unless given.
+    """
+    if name.lower().endswith(".xlsx"):
+        yield from _iter_xlsx_chunks(f, chunk_rows); return
+    reader = pd.read_csv(f, encoding=encoding or sniff_encoding(f), dtype=str, chunksize=chunk_rows, skip_blank_lines=True)
+    with reader:
+        yield from reader
+
+def import_manifest(f, name, on_chunk=None, chunk_rows=MANIFEST_CHUNK_ROWS, encoding=None):
+    """Streams a manifest into (records, issues), calling on_chunk(records, issues) after each chunk.
+
+    A CSV sniffed as UTF-8 that turns out not to be further down is read again from the start as
+    latin-1, so on_chunk can see the row counts restart.
+    """
+    records, issues, columns = [], [], None
+    try:
+        for df in iter_manifest_chunks(f, name, chunk_rows, encoding):
+            df = df.dropna(how="all")
+            if columns is None: columns = resolve_manifest_columns(df.columns)
+            issues.extend(validate_manifest(df, columns))
+            records.extend(normalize_manifest(df, columns))
+            if on_chunk: on_chunk(records, issues)
+    except UnicodeDecodeError:
+        if encoding == "latin-1": raise
+        f.seek(0)
+        return import_manifest(f, name, on_chunk, chunk_rows, "latin-1")
+    return records, issues
+
+@lru_cache(maxsize=None)
+def _process_context():
+    # Never plain fork: the app and CLI run thread pools, and forking a threaded process can deadlock the child
+    if "forkserver" not in multiprocessing.get_all_start_methods(): return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    # Workers fork from a server that imported the engine once; before 3.12 the server ignores our
+    # sys.path, so make sure PYTHONPATH lets it find this module whatever the working directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]
+    if here not in paths: os.environ["PYTHONPATH"] = os.pathsep.join([here] + paths)
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+def process_pool(workers):
+    """A ProcessPoolExecutor started via forkserver (spawn where unavailable); arguments must be picklable."""
+    return ProcessPoolExecutor(workers, mp_context=_process_context())
+
+# =====================================
+# 3) CACHING
+# =====================================
+
+class DiskCache:
+    """Content-addressed byte store with a byte budget (LRU eviction) and a TTL.
+
+    Each entry's mtime records when it was written (TTL) and its atime when it was last read (LRU).
+    """
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+            if time.time() - mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as fh: data = fh.read()
+            os.utime(path, (time.time(), mtime))
+            return data
+        except OSError: return None
+
+    def has(self, key):
+        """Whether a live entry exists, without reading it (get can still miss if it is evicted in between)."""
+        try: return time.time() - os.stat(self._path(key)).st_mtime <= self.ttl
+        except OSError: return False
+
+    def set(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as fh: fh.write(data)
+            os.replace(tmp, path)
+        except OSError: return
+        with self._lock:
+            if self._size is not None: self._size += len(data)
+            if self._size is None or self._size > self.max_bytes: self._evict()
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try: st_ = os.stat(path)
+                except OSError: continue
+                if name.endswith(".tmp") or now - st_.st_mtime > self.ttl:
+                    if now - st_.st_mtime > 60:
+                        try: os.remove(path)
+                        except OSError: pass
+                    continue
+                entries.append((st_.st_atime, st_.st_size, path))
+        total = sum(e[1] for e in entries)
+        if total > self.max_bytes:
+            # Trim to 90% of the budget so we don't evict again on the very next write
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * 0.9: break
+                try: os.remove(path); total -= size
+                except OSError: pass
+        self._size = total
+
+IMAGE_CACHE = DiskCache(os.path.join(CACHE_DIR, "images"), IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL)
+PDF_CACHE = DiskCache(os.path.join(CACHE_DIR, "pdfs"), PDF_CACHE_MAX_BYTES, PDF_CACHE_TTL)
+PAGE_CACHE = DiskCache(os.path.join(CACHE_DIR, "pages"), PAGE_CACHE_MAX_BYTES, PAGE_CACHE_TTL)
+
+def normalize_hotel_key(text):
+    return re.sub(r"[^a-z0-9]+", " ", str(text or "").lower()).strip()
+
+class HotelStore:
+    """SQLite store of everything we have resolved about a hotel (city, address, phone, check-in/out, rooms, images).
+
+    Rows are keyed by normalized hotel name + city, merged field by field on update, and ignored once
+    older than `ttl` seconds. Looking up without a city returns the most recently updated row for the name.
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("""CREATE TABLE IF NOT EXISTS hotels (
+            name_key TEXT NOT NULL, city_key TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL,
+            PRIMARY KEY (name_key, city_key))""")
+        return conn
+
+    def get(self, hotel, city=None):
+        name_key = normalize_hotel_key(hotel)
+        if not name_key: return None
+        sql = "SELECT data FROM hotels WHERE name_key = ? AND updated > ?"
+        args = [name_key, time.time() - self.ttl]
+        if city:
+            sql += " AND city_key = ?"; args.append(normalize_hotel_key(city))
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(sql + " ORDER BY updated DESC LIMIT 1", args).fetchone()
+        except sqlite3.Error: return None
+        return json.loads(row[0]) if row else None
+
+    def update(self, hotel, city, fields):
+        name_key, city_key = normalize_hotel_key(hotel), normalize_hotel_key(city)
+        if not name_key: return
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute("SELECT data FROM hotels WHERE name_key = ? AND city_key = ?", (name_key, city_key)).fetchone()
+                data = json.loads(row[0]) if row else {}
+                data.update({k: v for k, v in fields.items() if v})
+                conn.execute("INSERT OR REPLACE INTO hotels VALUES (?, ?, ?, ?)", (name_key, city_key, json.dumps(data), time.time()))
+        except sqlite3.Error: pass
+
+    def invalidate(self, hotel, city=None):
+        sql, args = "DELETE FROM hotels WHERE name_key = ?", [normalize_hotel_key(hotel)]
+        if city:
+            sql += " AND city_key = ?"; args.append(normalize_hotel_key(city))
+        try:
+            with closing(self._connect()) as conn, conn: conn.execute(sql, args)
+        except sqlite3.Error: pass
+
+HOTEL_STORE = HotelStore(os.path.join(CACHE_DIR, "hotels.sqlite3"), HOTEL_CACHE_TTL)
+
+class CounterStore:
+    """Named integer counters kept in SQLite, so they survive reruns and restarts and are shared across sessions."""
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        return conn
+
+    def incr(self, name, amount=1):
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, amount))
+                return conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+        except sqlite3.Error: return None
+
+    def get(self, prefix=""):
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute("SELECT name, value FROM counters WHERE substr(name, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        except sqlite3.Error: return {}
+        return dict(rows)
+
+STATS = CounterStore(os.path.join(CACHE_DIR, "stats.sqlite3"))
+
+class JobStore:
+    """SQLite table of background voucher jobs: status (queued/running/done/failed), pages done of total, output path.
+
+    `error` is the failure reason of a failed job, or a warning about a done one (e.g. rendered without images).
+    """
+    COLUMNS = ("id", "label", "status", "done", "total", "path", "error", "created", "updated")
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, label TEXT NOT NULL, status TEXT NOT NULL, done INTEGER NOT NULL, total INTEGER NOT NULL,
+            path TEXT, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)""")
+        return conn
+
+    def create(self, label, total):
+        job_id, now = uuid.uuid4().hex, time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO jobs VALUES (?, ?, 'queued', 0, ?, NULL, NULL, ?, ?)", (job_id, label, total, now, now))
+        return job_id
+
+    def update(self, job_id, **fields):
+        cols = [c for c in fields if c in self.COLUMNS[2:7]]
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(f"UPDATE jobs SET {', '.join(c + ' = ?' for c in cols)}, updated = ? WHERE id = ?",
+                             [fields[c] for c in cols] + [time.time(), job_id])
+        except sqlite3.Error: pass
+
+    def get_many(self, job_ids):
+        """Jobs by id, newest first; unknown or purged ids are skipped."""
+        if not job_ids: return []
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))}) ORDER BY created DESC", list(job_ids)).fetchall()
+        except sqlite3.Error: return []
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def fail_unfinished(self, reason):
+        """Marks queued/running jobs as failed, for jobs orphaned by a restart."""
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE status IN ('queued', 'running')", (reason, time.time()))
+        except sqlite3.Error: pass
+
+    def purge(self, ttl):
+        """Drops jobs (and their PDFs) created more than `ttl` seconds ago."""
+        try:
+            with closing(self._connect()) as conn, conn:
+                cutoff = time.time() - ttl
+                for (path,) in conn.execute("SELECT path FROM jobs WHERE created < ? AND path IS NOT NULL", (cutoff,)).fetchall():
+                    try: os.remove(path)
+                    except OSError: pass
+                conn.execute("DELETE FROM jobs WHERE created < ?", (cutoff,))
+        except sqlite3.Error: pass
+
+JOB_STORE = JobStore(os.path.join(CACHE_DIR, "jobs.sqlite3"))
+
+class HotelIndex:
+    """Trigram index of hotels we have issued vouchers for, kept in SQLite and mirrored in memory for typeahead.
+
+    The in-memory copy is updated incrementally: add() indexes its own row directly, and when the
+    database file changes (e.g. a CLI batch in another process) only rows used since the last load are read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._hotels, self._postings, self._mtime, self._since = {}, {}, None, -1.0
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("""CREATE TABLE IF NOT EXISTS issued (
+            name_key TEXT PRIMARY KEY, name TEXT NOT NULL, city TEXT NOT NULL, uses INTEGER NOT NULL, last_used REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS issued_last_used ON issued (last_used)")
+        return conn
+
+    @staticmethod
+    def _trigrams(key):
+        padded = f"  {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _index(self, name_key, name, city, uses):
+        grams = self._trigrams(name_key)
+        self._hotels[name_key] = (name, city, uses, len(grams))
+        for gram in grams: self._postings.setdefault(gram, set()).add(name_key)
+
+    def _refresh(self):
+        try: mtime = os.stat(self.path).st_mtime_ns
+        except OSError: return
+        if mtime == self._mtime: return
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute("SELECT name_key, name, city, uses, last_used FROM issued WHERE last_used > ?",
+                                    (self._since,)).fetchall()
+        except sqlite3.Error: return
+        self._mtime = mtime
+        for row in rows: self._index(*row[:4])
+        self._since = max([self._since] + [r[-1] for r in rows])
+
+    def add(self, name, city=""):
+        """Records a hotel we issued a voucher for (again)."""
+        name_key = normalize_hotel_key(name)
+        if not name_key: return
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("""INSERT INTO issued VALUES (?, ?, ?, 1, ?) ON CONFLICT(name_key) DO UPDATE SET
+                    name = excluded.name, city = CASE WHEN excluded.city != '' THEN excluded.city ELSE city END,
+                    uses = uses + 1, last_used = excluded.last_used""", (name_key, name, city or "", time.time()))
+                row = conn.execute("SELECT name_key, name, city, uses FROM issued WHERE name_key = ?", (name_key,)).fetchone()
+        except sqlite3.Error: return
+        # Once loaded, keep the in-memory copy current without waiting for the next refresh
+        with self._lock:
+            if self._mtime is not None: self._index(*row)
+
+    def search(self, query, limit=5):
+        """Returns [(score, name, city)], best first; score is the Jaccard similarity of query and name trigrams."""
+        key = normalize_hotel_key(query)
+        if not key: return []
+        grams = self._trigrams(key)
+        with self._lock:
+            self._refresh()
+            hits = Counter()
+            for gram in grams: hits.update(self._postings.get(gram, ()))
+            scored = [(n / (len(grams) + self._hotels[k][3] - n), k) for k, n in hits.items()]
+            ranked = sorted(scored, key=lambda sk: (-sk[0], -self._hotels[sk[1]][2]))[:limit]
+            return [(score, self._hotels[k][0], self._hotels[k][1]) for score, k in ranked]
+
+HOTEL_INDEX = HotelIndex(os.path.join(CACHE_DIR, "issued_hotels.sqlite3"))
+
+def normalize_image(data, slot=None, dpi=None, quality=None):
+    """Decodes any Pillow-readable image (JPEG, PNG with alpha, WebP, ...) and re-encodes it for a voucher slot.
+
+    The image is resized to the slot's pixel size at `dpi`, flattened onto white, and saved as a
+    progressive JPEG without EXIF or other metadata.
+    """
+    slot_w, slot_h = slot or IMAGE_SLOT_PT
+    px_w = max(1, round(slot_w * (dpi or IMAGE_DPI) / 72))
+    px_h = max(1, round(slot_h * (dpi or IMAGE_DPI) / 72))
+    im = Image.open(io.BytesIO(data))
+    im.draft("RGB", (px_w, px_h))  # lets JPEG decode at a reduced scale
+    im = ImageOps.exif_transpose(im)
+    if im.mode in ("RGBA", "LA", "P", "PA"):
+        im = im.convert("RGBA")
+        bg = Image.new("RGB", im.size, (255, 255, 255))
+        bg.paste(im, mask=im.split()[-1])
+        im = bg
+    elif im.mode != "RGB":
+        im = im.convert("RGB")
+    im = im.resize((px_w, px_h), Image.LANCZOS)
+    out = io.BytesIO()
+    im.save(out, "JPEG", quality=quality or IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+# =====================================
+# 4) AI & SEARCH FUNCTIONS
+# =====================================
+
+# --- RATE LIMITS, QUOTAS & REQUEST COALESCING ---
+class Throttled(Exception):
+    """An API call was refused by our rate limiter, our daily quota, or the API itself (429). Retry after `retry_after` seconds."""
+    def __init__(self, api, reason, retry_after):
+        super().__init__(f"{api} {reason}, retry in {retry_after:.0f}s")
+        self.api, self.reason, self.retry_after = api, reason, retry_after
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = float(burst), time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, max_wait):
+        """Takes a token, sleeping up to max_wait for one; returns 0, or the seconds still needed if that is too long."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            wait_s = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+            if wait_s > max_wait: return wait_s
+            self.tokens -= 1
+        if wait_s: time.sleep(wait_s)
+        return 0
+
+class ApiLimiter:
+    """Token bucket per process plus a daily call quota shared by every process through STATS."""
+    def __init__(self, api, rate, burst, daily_quota):
+        self.api, self.daily_quota = api, daily_quota
+        self.bucket = TokenBucket(rate, burst)
+
+    def acquire(self, max_wait=RATE_LIMIT_WAIT):
+        wait_s = self.bucket.take(max_wait)
+        if wait_s: raise Throttled(self.api, "rate limited", wait_s)
+        if not self.daily_quota: return
+        now = datetime.now(QUOTA_TZ)
+        name = f"quota:{self.api}:{now.date().isoformat()}"
+        used = STATS.incr(name)
+        if used is not None and used > self.daily_quota:
+            STATS.incr(name, -1)
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TZ)
+            raise Throttled(self.api, "daily quota used up", (midnight - now).total_seconds())
+
+    def used_today(self):
+        name = f"quota:{self.api}:{datetime.now(QUOTA_TZ).date().isoformat()}"
+        return STATS.get(name).get(name, 0)
+
+SEARCH_LIMITER = ApiLimiter("Custom Search", SEARCH_QPS, SEARCH_BURST, SEARCH_DAILY_QUOTA)
+GEMINI_LIMITER = ApiLimiter("Gemini", GEMINI_QPS, GEMINI_BURST, GEMINI_DAILY_QUOTA)
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first caller runs fn, the rest wait for its result (or exception)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader: fut = self._calls[key] = Future()
+        if not leader: return fut.result()
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock: self._calls.pop(key, None)
+        return fut.result()
+
+API_CALLS = SingleFlight()
+
+class Retryable(Exception):
+    """Raised by a limited_call fn for a transient failure; `outcome` (an exception to raise, or a value to return) is used once retries run out."""
+    def __init__(self, outcome=None, retry_after=None):
+        super().__init__(str(outcome))
+        self.outcome, self.retry_after = outcome, retry_after
+
+def limited_call(limiter, key, fn, *args, retries=0):
+    """Runs fn(*args) once per distinct in-flight `key`, after taking a token from `limiter`.
+
+    If fn raises Retryable it is called again, up to `retries` more times, after a jittered backoff (or the
+    server's capped Retry-After). Every attempt takes its own token, so retries count against rate and quota.
+    """
+    def run():
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            try: return fn(*args)
+            except Retryable as e:
+                if attempt == retries:
+                    if isinstance(e.outcome, BaseException): raise e.outcome from e
+                    return e.outcome
+                wait_s = random.uniform(0, 0.5 * 2 ** attempt) if e.retry_after is None else min(e.retry_after, HTTP_RETRY_AFTER_MAX)
+                time.sleep(wait_s)
+    return API_CALLS.do((limiter.api, key), run)
+
+def gemini_generate(model, prompt):
+    """model.generate_content(prompt) through GEMINI_LIMITER; identical in-flight prompts share one call."""
+    def call():
+        try: return model.generate_content(prompt).text
+        except (ResourceExhausted, TooManyRequests) as e: raise Throttled("Gemini", "rejected the request (429)", 30) from e
+    return limited_call(GEMINI_LIMITER, hashlib.sha256(f"{model.model_name}\n{prompt}".encode("utf-8")).hexdigest(), call)
+
+def _retry_after(res):
+    try: return float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError): return None
+
+def search_get(params):
+    """Custom Search request through SEARCH_LIMITER; a 429 or quota 403 from Google becomes Throttled, other failures return None.
+
+    429s, 5xxs and connection errors are retried (HTTP_RETRIES times) inside limited_call rather than by the
+    HTTP session, so each retry is metered by the limiter like the first request.
+    """
+    def call():
+        try: res = http_get("https://www.googleapis.com/customsearch/v1", retry=False, params={**params, "cx": SEARCH_CX, "key": SEARCH_KEY})
+        except (requests.ConnectionError, requests.Timeout) as e: raise Retryable(e) from e
+        if res.status_code == 429:
+            raise Retryable(Throttled("Custom Search", "rejected the request (429)", _retry_after(res) or 60), _retry_after(res))
+        if res.status_code == 403 and "quota" in res.text.lower():
+            raise Throttled("Custom Search", "rejected the request (403)", _retry_after(res) or 60)
+        if res.status_code >= 500: raise Retryable(None, _retry_after(res))
+        return res.json() if res.status_code == 200 else None
+    return limited_call(SEARCH_LIMITER, json.dumps(params, sort_keys=True), call, retries=HTTP_RETRIES)
+
+LLM_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm")
+
+PDF_PARSE_PROMPT = """You are a Hotel Voucher Parser. Extract details from this text.
+
+CRITICAL RULES:
+1. "rooms": Extract a list. For each room, find 'guest_name', 'confirmation_no', 'adults' (int), and 'children' (int).
+2. IF "children" count is not explicit, assume 0.
+3. IF "confirmation_no" is missing, return empty string "".
+4. The text may be one part of a longer document. Return only the rooms that appear in it and "" for fields it does not mention.
+
+Text content:
+{text}
+
+Return JSON ONLY: 
+{{ 
+    "hotel_name": "Name", "city": "City", 
+    "checkin_raw": "DateStr", "checkout_raw": "DateStr", 
+    "meal_plan": "Plan", "room_type": "Type", "room_size": "Size",
+    "rooms": [ 
+        {{"guest_name": "Name", "confirmation_no": "12345", "adults": 2, "children": 0}} 
+    ] 
+}}"""
+
+def _extract_page_range(pdf_bytes, start, stop):
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def extract_pdf_pages(pdf_bytes):
+    """Text of every page; long documents are split into page ranges extracted in a process pool."""
+    n_pages = len(pypdf.PdfReader(io.BytesIO(pdf_bytes)).pages)
+    workers = min(RENDER_WORKERS, n_pages // PDF_EXTRACT_MIN_PAGES)
+    if workers < 2: return _extract_page_range(pdf_bytes, 0, n_pages)
+    size = -(-n_pages // workers)
+    starts = list(range(0, n_pages, size))
+    with process_pool(workers) as pool:
+        parts = pool.map(_extract_page_range, repeat(pdf_bytes), starts, [min(start + size, n_pages) for start in starts])
+        return [text for part in parts for text in part]
+
+PAGE_COUNTER = re.compile(r"(?i)\bpage\b|\d+\s*(?:/|of)\s*\d+")
+
+def split_repeated_lines(pages, edge_lines=3):
+    """Separates running headers/footers from page bodies.
+
+    A line counts as repeated when it is among the first or last `edge_lines` lines of at least 60% of
+    the pages; numbers are ignored in page counters so "Page 2 of 9" matches. Only lines in those edge
+    positions are removed. Returns (repeated lines in first-seen order, page texts without them).
+    """
+    if len(pages) < 3: return [], pages
+    shape = lambda line: re.sub(r"\d+", "#", line.strip()) if PAGE_COUNTER.search(line) else line.strip()
+    split = []
+    for text in pages:
+        lines = [l for l in text.splitlines() if l.strip()]
+        cut = max(edge_lines, len(lines) - edge_lines)
+        split.append((lines[:edge_lines], lines[edge_lines:cut], lines[cut:]))
+    counts = Counter()
+    for head, _, tail in split: counts.update({shape(l) for l in head + tail})
+    repeated = {k for k, n in counts.items() if n >= max(3, 0.6 * len(pages))}
+    header, kept, bodies = [], set(), []
+    for head, middle, tail in split:
+        for line in head + tail:
+            if shape(line) in repeated and shape(line) not in kept:
+                kept.add(shape(line)); header.append(line.strip())
+        body = [l for l in head if shape(l) not in repeated] + middle + [l for l in tail if shape(l) not in repeated]
+        bodies.append("\n".join(body))
+    return header, bodies
+
+def chunk_pages(pages, budget):
+    """Packs page texts into chunks of at most `budget` characters, splitting oversized pages on line breaks."""
+    chunks, current = [], ""
+    for text in pages:
+        pieces = [text] if len(text) <= budget else [
+            line[i:i + budget] for line in text.splitlines() for i in range(0, max(len(line), 1), budget)
+        ]
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > budget:
+                chunks.append(current); current = ""
+            current = f"{current}\n{piece}" if current else piece
+    if current: chunks.append(current)
+    return chunks
+
+def _parse_voucher_chunk(text):
+    model = genai.GenerativeModel('gemini-2.0-flash', generation_config={"response_mime_type": "application/json"})
+    data = json.loads(gemini_generate(model, PDF_PARSE_PROMPT.format(text=text)))
+    if not isinstance(data, dict): raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+    return data
+
+def merge_voucher_parts(parts):
+    """Combines per-chunk parses: the first non-empty value wins for each field and rooms are concatenated.
+
+    A room repeated from an earlier chunk (same confirmation number and guest, e.g. a summary printed on
+    every page) is dropped, but only when that key was unique in both chunks: a key that repeats inside
+    one chunk ("TBA" rooms under a group confirmation number) does not identify a room.
+    """
+    merged, rooms, unique, ambiguous = {}, [], set(), set()
+    room_key = lambda r: (str(r.get("confirmation_no") or "").strip(), " ".join(re.findall(r"[a-z0-9]+", str(r.get("guest_name") or "").lower())))
+    for part in parts:
+        for k, v in part.items():
+            if k != "rooms" and v and not merged.get(k): merged[k] = v
+        part_rooms = [r for r in part.get("rooms") or [] if isinstance(r, dict)]
+        counts = Counter(room_key(r) for r in part_rooms)
+        rooms.extend(r for r in part_rooms if not (counts[room_key(r)] == 1 and room_key(r) in unique))
+        for key, n in counts.items():
+            if n > 1: ambiguous.add(key)
+        unique.update(k for k, n in counts.items() if n == 1)
+        unique -= ambiguous
+    merged["rooms"] = rooms
+    return merged
+
+# --- LOCAL PARSERS FOR KNOWN SUPPLIER LAYOUTS ---
+PDF_LAYOUT_PARSERS = []
+
+def pdf_layout(name, fingerprint):
+    """Registers a local parser for a known supplier layout.
+
+    `fingerprint` is a regex searched in the extracted PDF text; when it matches, the decorated function gets
+    the text and returns the same dict shape as the Gemini parser (hotel_name, checkin_raw, rooms[], ...) or
+    None to fall through to the next parser.
+    """
+    def register(parse):
+        PDF_LAYOUT_PARSERS.append((name, re.compile(fingerprint), parse))
+        return parse
+    return register
+
+def parse_known_layout(text):
+    """Returns (layout name, parsed dict) from the first registered parser that recognizes the text, else (None, None)."""
+    for name, fingerprint, parse in PDF_LAYOUT_PARSERS:
+        if not fingerprint.search(text): continue
+        try: parsed = parse(text)
+        except Exception as e:
+            print(f"Layout parser {name} failed: {e}")
+            continue
+        if parsed and parsed.get("rooms"): return name, parsed
+    return None, None
+
+def pdf_parse_hit_rate():
+    """Share of parsed PDFs that were handled by a local layout parser instead of Gemini (cache hits excluded)."""
+    counts = STATS.get("pdf_parse:")
+    llm = counts.pop("pdf_parse:llm", 0); counts.pop("pdf_parse:cache", None)
+    local = sum(counts.values())
+    return local, local + llm
+
+# Our own vouchers (generate_pdf_final), uploaded again to amend or reissue them: one page per room
+ODADUU_VOUCHER_PAGE = re.compile(
+    r"HOTEL CONFIRMATION VOUCHER\nGUEST INFORMATION\n"
+    r"Guest Name:\n(?P<guest>.+?)\nNo\. of Pax:\n(?P<adults>\d+) Adults(?:, (?P<children>\d+) Children)?\n"
+    r"Cancellation:\n.*?\nHOTEL DETAILS\nHotel:\n(?P<hotel>.+?)\nAddress:\n.*?Check-In:\n(?P<checkin>.+?)\nCheck-Out:\n(?P<checkout>.+?)\n"
+    r"ROOM INFORMATION\nRoom Type:\n(?:(?P<room_type>.+?)\n)?Room Size:\n(?P<room_size>.+?)\n"
+    r"Confirmation No\.:\n(?:(?P<conf>.+?)\n)?Meal Plan:\n(?P<meal>.+?)\nNo\. of Nights:\n", re.S)
+
+@pdf_layout("odaduu_voucher", rf"(?ms)\A\s*HOTEL CONFIRMATION VOUCHER\nGUEST INFORMATION\n.*^Issued by: {re.escape(COMPANY_NAME)}$")
+def parse_odaduu_voucher(text):
+    """Our own voucher layout. Returns None unless every page parses and they all describe the same stay."""
+    pages = [p for p in re.split(r"(?m)^(?=HOTEL CONFIRMATION VOUCHER$)", text) if p.strip()]
+    found = [ODADUU_VOUCHER_PAGE.search(p) for p in pages]
+    if not found or not all(found): return None
+    one_line = lambda v: " ".join((v or "").split())
+    shared = {(one_line(m["hotel"]), m["checkin"], m["checkout"], one_line(m["room_type"]), m["room_size"], m["meal"]) for m in found}
+    if len(shared) != 1: return None
+    hotel, checkin, checkout, room_type, room_size, meal = shared.pop()
+    if not parse_smart_date(checkin) or not parse_smart_date(checkout): return None
+    # A page printed without a number takes the booking's, when every other page agrees on one
+    confs = {one_line(m["conf"]) for m in found if m["conf"]}
+    doc_conf = confs.pop() if len(confs) == 1 else ""
+    return {
+        "hotel_name": hotel, "city": "", "checkin_raw": checkin, "checkout_raw": checkout,
+        "meal_plan": meal, "room_type": room_type, "room_size": "" if room_size == "N/A" else room_size,
+        "rooms": [{
+            "guest_name": one_line(m["guest"]), "confirmation_no": one_line(m["conf"]) or doc_conf,
+            "adults": int(m["adults"]), "children": int(m["children"] or 0),
+        } for m in found],
+    }
+
+def pdf_digest(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def extract_pdf_data(pdf_file):
+    """Parses a supplier voucher PDF; results are cached by the SHA-256 of the file's bytes."""
+    pdf_bytes = pdf_file.getvalue() if hasattr(pdf_file, "getvalue") else pdf_file.read()
+    cache_key = f"pdf:{PDF_PARSE_VERSION}:{pdf_digest(pdf_bytes)}"
+    cached = PDF_CACHE.get(cache_key)
+    if cached:
+        STATS.incr("pdf_parse:cache")
+        return json.loads(cached)
+    try:
+        pages = extract_pdf_pages(pdf_bytes)
+        layout, parsed = parse_known_layout("\n".join(pages))
+        if parsed:
+            STATS.incr(f"pdf_parse:{layout}")
+            PDF_CACHE.set(cache_key, json.dumps(parsed).encode("utf-8"))
+            return parsed
+        if not GEMINI_KEY: return None
+        header, bodies = split_repeated_lines(pages)
+        # Running headers usually carry the hotel and stay dates: keep one copy at the top of every chunk
+        header_text = "\n".join(header)
+        budget = max(PDF_CHUNK_CHARS - len(header_text), PDF_CHUNK_CHARS // 2)
+        chunks = [f"{header_text}\n{c}" if header_text else c for c in chunk_pages(bodies, budget)]
+        parsed = merge_voucher_parts(list(LLM_POOL.map(_parse_voucher_chunk, chunks)))
+        STATS.incr("pdf_parse:llm")
+        PDF_CACHE.set(cache_key, json.dumps(parsed).encode("utf-8"))
+        return parsed
+    except Throttled: raise
+    except Exception as e:
+        print(f"PDF Error: {e}")
+        return None
+
+HOTEL_DETAIL_FIELDS = ("addr1", "addr2", "phone", "in", "out")
+
+HOTEL_ENRICHMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "city": {"type": "string"},
+        "rooms": {"type": "array", "items": {"type": "string"}},
+        "addr1": {"type": "string"},
+        "addr2": {"type": "string"},
+        "phone": {"type": "string"},
+        "checkin_time": {"type": "string"},
+        "checkout_time": {"type": "string"},
+    },
+    "required": ["city", "rooms", "addr1", "addr2", "phone", "checkin_time", "checkout_time"],
+}
+
+@dataclass
+class HotelRecord:
+    """Everything one enrichment request returns for a hotel."""
+    city: str = ""
+    rooms: list = field(default_factory=list)
+    addr1: str = ""
+    addr2: str = ""
+    phone: str = ""
+    checkin_time: str = ""
+    checkout_time: str = ""
+
+    @classmethod
+    def from_response(cls, data):
+        if not isinstance(data, dict): raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        rooms = data.get("rooms") or []
+        if not isinstance(rooms, list): raise ValueError("'rooms' must be a list")
+        text = lambda k: clean_extracted_text(data.get(k) or "")
+        return cls(
+            city=text("city"), rooms=[clean_room_type_string(r) for r in rooms if str(r).strip()],
+            addr1=text("addr1"), addr2=text("addr2"), phone=text("phone"),
+            checkin_time=text("checkin_time"), checkout_time=text("checkout_time"),
+        )
+
+    def details(self):
+        return {"addr1": self.addr1, "addr2": self.addr2, "phone": self.phone, "in": self.checkin_time, "out": self.checkout_time}
+
+def enrich_hotel(hotel, city=""):
+    """Resolves city, room types, address, phone and check-in/out times in a single Gemini call.
+
+    The reply is constrained to HOTEL_ENRICHMENT_SCHEMA, validated into a HotelRecord and saved to HOTEL_STORE.
+    Returns None if Gemini is not configured or the call fails; raises Throttled when rate limited.
+    """
+    if not GEMINI_KEY: return None
+    where = f"{hotel} {city}".strip()
+    search_res = google_search(f"{where} official site rooms accommodation")
+    snippets = "\n".join([i.get('snippet','') for i in search_res])
+    prompt = f"""Based on these search results for "{where}":\n{snippets}
+1. Identify the City.
+2. List 3-5 official room categories.
+3. Give the street address (addr1), the city/postcode line (addr2) and the international phone number.
+4. Give the standard check-in and check-out times (e.g. "3:00 PM")."""
+    model = genai.GenerativeModel('gemini-2.0-flash', generation_config={
+        "response_mime_type": "application/json", "response_schema": HOTEL_ENRICHMENT_SCHEMA,
+    })
+    try:
+        record = HotelRecord.from_response(json.loads(gemini_generate(model, prompt)))
+    except Throttled: raise
+    except Exception as e:
+        print(f"Enrichment Error: {e}")
+        return None
+    HOTEL_STORE.update(hotel, record.city or city, {"city": record.city, "rooms": record.rooms, **record.details()})
+    return record
+
+def fetch_hotel_details_text(hotel, city, r_type):
+    record = HOTEL_STORE.get(hotel, city)
+    # Rows are filed under the city enrichment found ("Shinjuku City"); a voucher typed as "Tokyo" still matches by name
+    if city and not (record and record.get("addr1")): record = HOTEL_STORE.get(hotel)
+    if record and record.get("addr1"):
+        return {k: record.get(k, "") for k in HOTEL_DETAIL_FIELDS}
+    enriched = enrich_hotel(hotel, city)
+    return enriched.details() if enriched else {}
+
+def hotel_profile(hotel, city="", cancelled=None, on_update=None, refresh=False):
+    """Returns (city, room_types, image_urls) for a hotel, from the store when known, else enriched and searched.
+
+    room_types is None when there was nothing to look them up with (no store record and no Gemini key);
+    `city` is kept as-is in that case and used for the image search. If the `cancelled` Event gets set,
+    the lookup stops with CancelledError before its next network stage. `on_update(**fields)` receives
+    city/rooms/images as soon as each is known, ahead of the final result. `refresh` skips cached image
+    search results (see fetch_images).
+    """
+    def checkpoint():
+        if cancelled is not None and cancelled.is_set(): raise CancelledError()
+    publish = on_update or (lambda **fields: None)
+
+    rooms = None
+    record = HOTEL_STORE.get(hotel)
+    if record and record.get("rooms"):
+        city, rooms = record.get("city", ""), record["rooms"]
+        if record.get("images"): return city, rooms, record["images"]
+        publish(city=city, rooms=rooms)
+        images = get_smart_images(hotel, city, refresh)
+    elif GEMINI_KEY:
+        checkpoint()
+        # Search + Gemini and a name-only image search run side by side; once the city is known it
+        # only refines the image slots, so the form fills in as soon as the slower of the two returns
+        enriching = LLM_POOL.submit(enrich_hotel, hotel)
+        try: rough = get_smart_images(hotel, "", refresh)
+        except Throttled: rough = [None] * len(IMAGE_QUERY_SUFFIXES)
+        if any(rough): publish(images=rough)
+        enriched = enriching.result()
+        city = enriched.city if enriched else ""
+        rooms = enriched.rooms if enriched and enriched.rooms else ["Standard", "Deluxe"]
+        publish(city=city, rooms=rooms)
+        checkpoint()
+        images = rough
+        if city:
+            try: images = [fine or coarse for fine, coarse in zip(get_smart_images(hotel, city, refresh), rough)]
+            except Throttled:
+                if not any(rough): raise
+    else:
+        checkpoint()
+        images = get_smart_images(hotel, city, refresh)
+
+    if any(images): HOTEL_STORE.update(hotel, city, {"images": images})
+    return city, rooms, images
+
+@dataclass
+class _LookupFlight:
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    progress: dict = field(default_factory=dict)
+    future: Future = None
+    interest: int = 0
+
+@dataclass(frozen=True)
+class HotelLookup:
+    """Handle for one caller's interest in a hotel lookup.
+
+    `progress` fills in with city/rooms/images as they arrive, bumping progress["version"] each time;
+    `future` resolves to hotel_profile's final result.
+    """
+    hotel: str
+    key: str
+    future: Future
+    progress: dict
+
+class HotelLookups:
+    """Single-flight hotel_profile lookups, keyed by normalized hotel name.
+
+    Everyone asking for the same hotel while a lookup is running shares it. A caller passes its previous
+    handle as `supersedes` when it moves on; a lookup that nobody is waiting for any more is cancelled
+    (dropped if still queued, stopped at its next stage if running).
+    """
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hotel-lookup")
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def start(self, hotel, city="", supersedes=None, refresh=False):
+        key = normalize_hotel_key(hotel)
+        with self._lock:
+            if supersedes is not None: self._release(supersedes)
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _LookupFlight()
+                flight.future = self.pool.submit(self._run, key, flight, hotel, city, refresh)
+            flight.interest += 1
+            return HotelLookup(hotel, key, flight.future, flight.progress)
+
+    def release(self, lookup):
+        with self._lock: self._release(lookup)
+
+    def _release(self, lookup):
+        flight = self._flights.get(lookup.key)
+        if flight is None or flight.future is not lookup.future: return
+        flight.interest -= 1
+        if flight.interest <= 0:
+            flight.cancelled.set(); flight.future.cancel()
+            del self._flights[lookup.key]
+
+    def _run(self, key, flight, hotel, city, refresh):
+        def on_update(**fields):
+            flight.progress.update(fields, version=flight.progress.get("version", 0) + 1)
+        try:
+            city, rooms, images = hotel_profile(hotel, city, flight.cancelled, on_update, refresh)
+            on_update(city=city, images=images, **({"rooms": rooms} if rooms is not None else {}))
+            return city, rooms, images
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight: del self._flights[key]
+
+HOTEL_LOOKUPS = HotelLookups(HOTEL_LOOKUP_WORKERS)
+
+def get_smart_images(hotel, city, refresh=False):
+    base_q = f"{hotel} {city}"
+    return fetch_images([f"{base_q} {suffix}" for suffix in IMAGE_QUERY_SUFFIXES], refresh)
+
+# --- SHARED HTTP CLIENT ---
+class _JitteredRetry(Retry):
+    """Retry with full jitter, so concurrent workers that hit the same 429 don't come back in lockstep."""
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+    def get_retry_after(self, response):
+        # A host asking for an hour would otherwise hold a lookup or job thread for that long
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+class HttpMetrics:
+    """Per-host request counts, errors (exceptions and 4xx/5xx) and recent latencies."""
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.window = window
+
+    def record(self, host, seconds, ok):
+        with self._lock:
+            h = self._hosts.setdefault(host, {"requests": 0, "errors": 0, "latency": deque(maxlen=self.window)})
+            h["requests"] += 1; h["errors"] += not ok; h["latency"].append(seconds)
+
+    def snapshot(self):
+        """{host: {"requests", "errors", "p50_ms", "p95_ms"}} over the last `window` requests per host."""
+        with self._lock:
+            out = {}
+            for host, h in self._hosts.items():
+                lat = sorted(h["latency"])
+                out[host] = {"requests": h["requests"], "errors": h["errors"],
+                             "p50_ms": round(lat[len(lat) // 2] * 1000), "p95_ms": round(lat[int(len(lat) * 0.95)] * 1000)}
+            return out
+
+def _http_session(retries=HTTP_RETRIES):
+    retry = _JitteredRetry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                           allowed_methods=("GET", "HEAD"), respect_retry_after_header=True, raise_on_status=False) if retries else 0
+    # pool_block caps open connections per host; extra threads wait for a free one instead of opening more
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter); session.mount("http://", adapter)
+    return session
+
+HTTP = _http_session()
+HTTP_ONCE = _http_session(retries=0)
+HTTP_METRICS = HttpMetrics()
+
+def http_get(url, timeout=HTTP_TIMEOUT, retry=True, **kwargs):
+    """GET through the shared keep-alive session, with a timeout always set; records per-host metrics.
+
+    retry=False sends exactly one request: for calls with a tight latency budget, and for metered APIs
+    whose every request must pass through their ApiLimiter.
+    """
+    start, ok = time.perf_counter(), False
+    try:
+        res = (HTTP if retry else HTTP_ONCE).get(url, timeout=timeout, **kwargs)
+        ok = res.status_code < 400
+        return res
+    finally:
+        HTTP_METRICS.record(urlsplit(url).hostname or "", time.perf_counter() - start, ok)
+
+def google_search(query, num=5):
+    """Web results for `query`; [] on errors, Throttled when rate limited or out of quota."""
+    if not SEARCH_KEY or not SEARCH_CX: return []
+    try: data = search_get({"q": query, "num": num})
+    except Throttled: raise
+    except Exception as e:
+        print(f"Search Error: {e}")
+        return []
+    return (data or {}).get("items", [])
+
+def find_hotel_options(keyword):
+    """Hotels we have issued before come first; Google is only skipped when one of them is (nearly) the name typed.
+
+    A partial name such as a chain's ("Hotel Gracery") still gets Google's results after the issued
+    matches, so other properties of a chain we have used remain findable.
+    """
+    if not keyword: return []
+    hits = HOTEL_INDEX.search(keyword)
+    hotels = [name for score, name, _ in hits if score >= HOTEL_MATCH_SHOW]
+    if any(score >= HOTEL_MATCH_MIN for score, _, _ in hits): return hotels[:5]
+    hotels = hotels[:3]  # leave Google room in the five options
+    results = google_search(f"{keyword} hotel official site")
+    for item in results:
+        title = item.get('title', '').split('|')[0].split('-')[0].strip()
+        if title and title not in hotels: hotels.append(title)
+    return hotels[:5]
+
+# --- CONCURRENT IMAGE RESOLVER ---
+IMAGE_QUERY_SUFFIXES = [
+    "building exterior architecture daytime",
+    "hotel lobby interior design luxury",
+    "guest room bedroom interior design",
+]
+IMAGE_POOL = ThreadPoolExecutor(max_workers=12, thread_name_prefix="image-resolver")
+
+def _search_image_links(query):
+    # Fetch 3 candidates to ensure at least one works
+    data = search_get({"q": query, "searchType": "image", "num": 3, "imgSize": "large", "safe": "active"})
+    # WebP and other formats are fine: get_img_reader re-encodes everything to JPEG
+    return [item.get("link") for item in (data or {}).get("items", []) if item.get("link")]
+
+def _probe_link(link):
+    with http_get(link, timeout=(2, 2), retry=False, stream=True) as r:
+        return r.status_code == 200
+
+def fetch_images(queries, refresh=False):
+    """Resolves one live image link per query.
+
+    All searches run at once, and each search's candidates are probed as soon as it returns.
+    The first healthy candidate wins its query and the slower probes for that query are dropped.
+    Cached winners are reused without probing unless `refresh`, which searches again and replaces them.
+    Raises Throttled if nothing resolved because searches were rate limited.
+    """
+    results = [None] * len(queries)
+    if not SEARCH_KEY or not SEARCH_CX: return results
+    pending, throttled = {}, None
+    for i, q in enumerate(queries):
+        cached = None if refresh else IMAGE_CACHE.get(f"search:{q.strip().lower()}")
+        if cached: results[i] = cached.decode("utf-8")
+        else: pending[IMAGE_POOL.submit(_search_image_links, q)] = (i, None)
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut not in pending: continue
+            i, link = pending.pop(fut)
+            try: value = fut.result()
+            except Throttled as e: throttled = e; continue
+            except Exception: continue
+            if link is None:
+                for candidate in value:
+                    pending[IMAGE_POOL.submit(_probe_link, candidate)] = (i, candidate)
+            elif value:
+                results[i] = link
+                IMAGE_CACHE.set(f"search:{queries[i].strip().lower()}", link.encode("utf-8"))
+                for other, (j, _) in list(pending.items()):
+                    if j == i:
+                        other.cancel()
+                        del pending[other]
+    # Partial results are still useful; only an all-empty answer caused by throttling is reported as such
+    if throttled and not any(results): raise throttled
+    return results
+
+def fetch_image(query):
+    return fetch_images([query])[0]
+
+def get_img_bytes(url):
+    if not url: return None
+    cache_key = f"url:{url}:{IMAGE_SLOT_PT}@{IMAGE_DPI}q{IMAGE_JPEG_QUALITY}"
+    cached = IMAGE_CACHE.get(cache_key)
+    if cached: return cached
+    try:
+        r = http_get(url, timeout=(3.05, 4))
+        if r.status_code != 200: return None
+        data = normalize_image(r.content)
+        IMAGE_CACHE.set(cache_key, data)
+        return data
+    except: return None
+
+def get_img_reader(url):
+    data = get_img_bytes(url)
+    return ImageReader(io.BytesIO(data)) if data else None
+
+def prepare_images(imgs):
+    """Downloads and normalizes each distinct image once; URLs become JPEG bytes that every page (and worker) can reuse."""
+    fetched = {}
+    prepared = []
+    for im in imgs:
+        if isinstance(im, str):
+            if im not in fetched: fetched[im] = get_img_bytes(im)
+            im = fetched[im]
+        prepared.append(im)
+    return prepared
+
+# =====================================
+# 5) PDF GENERATION
+# =====================================
+
+def draw_vector_seal(c, x, y):
+    c.saveState()
+    # Seal text is 90% BRAND_BLUE on white, pre-blended: the seal lives in a Form XObject
+    # and ReportLab does not give forms ExtGState resources, so setFillAlpha would be lost
+    c.setStrokeColor(BRAND_BLUE); c.setFillColor(SEAL_TEXT_COLOR); c.setLineWidth(1.5)
+    cx, cy = x + 40, y + 40
+    c.circle(cx, cy, 40, stroke=1, fill=0)
+    c.setLineWidth(0.5); c.circle(cx, cy, 36, stroke=1, fill=0)
+    c.setFont("Helvetica-Bold", 10); c.drawCentredString(cx, cy + 4, "ODADUU")
+    c.setFont("Helvetica-Bold", 7); c.drawCentredString(cx, cy - 6, "TRAVEL DMC")
+    c.setFont("Helvetica-Bold", 6)
+    text_top = "CERTIFIED VOUCHER"; angle_start = 140
+    for i, char in enumerate(text_top):
+        angle = angle_start - (i * 10); rad = radians(angle)
+        tx = cx + 32 * cos(rad); ty = cy + 32 * sin(rad)
+        c.saveState(); c.translate(tx, ty); c.rotate(angle - 90); c.drawCentredString(0, 0, char); c.restoreState()
+    text_bot = "OFFICIAL"; angle_start = 240
+    for i, char in enumerate(text_bot):
+        angle = angle_start + (i * 12); rad = radians(angle)
+        tx = cx + 32 * cos(rad); ty = cy + 32 * sin(rad)
+        c.saveState(); c.translate(tx, ty); c.rotate(angle + 90); c.drawCentredString(0, 0, char); c.restoreState()
+    c.restoreState()
+
+def _draw_header(c, w, y_top):
+    logo_w, logo_h = 140, 55
+    try: 
+        c.drawImage(LOGO_FILE, (w - logo_w)/2, y_top - logo_h, logo_w, logo_h, mask='auto', preserveAspectRatio=True)
+    except: 
+        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 24); c.drawCentredString(w / 2, y_top - 35, "ODADUU")
+    c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 16)
+    c.drawCentredString(w / 2, y_top - logo_h - 20, "HOTEL CONFIRMATION VOUCHER")
+    return y_top - logo_h - 40
+
+BASE_STYLES = getSampleStyleSheet()
+ADDR_STYLE = ParagraphStyle("addr", parent=BASE_STYLES["Normal"], fontSize=7.5, leading=9, fontName="Helvetica-Bold", textColor=black)
+REMARK_STYLE = ParagraphStyle("remark", parent=BASE_STYLES["Normal"], fontSize=7.5, leading=9, fontName="Helvetica-Bold", textColor=black)
+
+INFO_TABLE_STYLE = TableStyle([
+    ("SPAN", (0, 0), (-1, 0)), ("ALIGN", (0, 0), (-1, 0), "LEFT"),
+    ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 7.5),
+    ("TEXTCOLOR", (0, 0), (-1, 0), BRAND_BLUE), ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("LEFTPADDING", (0,0), (-1,-1), 0),
+])
+MASTER_TABLE_STYLE = TableStyle([
+    ("SPAN", (0, 1), (1, 1)), # Span Room
+    ("BOX", (0, 0), (-1, -1), 1.5, black), 
+    ("LINEBELOW", (0, 0), (1, 0), 0.5, lightgrey), 
+    ("LINEAFTER", (0, 0), (0, 0), 0.5, lightgrey),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("TOPPADDING", (0, 0), (-1, -1), 3), ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
+    ("LEFTPADDING", (0, 0), (-1, -1), 6), ("RIGHTPADDING", (0, 0), (-1, -1), 6),
+])
+
+class _FixedParagraph(Paragraph):
+    """A Paragraph whose text never changes between pages: it breaks its lines once per width and then reuses them."""
+    def wrap(self, availWidth, availHeight):
+        if getattr(self, "_wrapped_width", None) != availWidth:
+            self._wrapped_size = Paragraph.wrap(self, availWidth, availHeight)
+            self._wrapped_width = availWidth
+        return self._wrapped_size
+
+def _info_table(title, rows, col_widths, row_heights=None):
+    t = Table([[title, ""]] + rows, colWidths=col_widths, rowHeights=row_heights)
+    t.setStyle(INFO_TABLE_STYLE)
+    return t
+
+def _measure_rows(title, rows, col_widths, dynamic=()):
+    """Row heights of an info table, measured once; rows listed in `dynamic` stay None so each page re-measures only those."""
+    t = _info_table(title, rows, col_widths)
+    t.wrap(sum(col_widths), 9999)
+    return [None if i - 1 in dynamic else rh for i, rh in enumerate(t._rowHeights)]
+
+def _draw_merged_info_box(c, x, y, w, t_guest, t_hotel, t_room):
+    master_table = Table([[t_guest, t_hotel], [t_room, ""]], colWidths=[w/2, w/2])
+    master_table.setStyle(MASTER_TABLE_STYLE)
+    tw, th = master_table.wrapOn(c, w, 9999)
+    master_table.drawOn(c, x, y - th)
+    return y - th - 15
+
+def _draw_shared_image(c, img, x, y, w, h):
+    """Embeds img as an XObject on its first use in this canvas; later pages only reference it."""
+    names = c.__dict__.setdefault("_shared_image_names", {})
+    name = names.get(id(img))
+    if name is None:
+        ret = {"name": None}
+        c.drawImage(img, x, y, w, h, preserveAspectRatio=False, anchor='c', extraReturn=ret)
+        names[id(img)] = ret["name"]
+        return
+    c.saveState(); c.translate(x, y); c.scale(w, h); c.doForm(name); c.restoreState()
+
+# --- FIXED IMAGE ROW (UNIFORM 100pt, 0.75 Gap) ---
+def _draw_image_row(c, x, y, w, imgs, scale_factor=1.0):
+    valid = [im for im in imgs if im]
+    if not valid: return y
+
+    gap = 0.75 * scale_factor 
+    img_w = (w - (2 * gap)) / 3
+    img_h = 100 * scale_factor 
+    
+    for i in range(min(3, len(valid))):
+        im = valid[i]
+        curr_x = x + (i * (img_w + gap))
+        try: _draw_shared_image(c, im, curr_x, y - img_h, img_w, img_h)
+        except: pass
+        
+    return y - img_h - (10 * scale_factor)
+
+POLICY_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), BRAND_BLUE), ("TEXTCOLOR", (0, 0), (-1, 0), white),
+    ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"), ("FONTSIZE", (0, 0), (-1, -1), 8.5),
+    ("GRID", (0, 0), (-1, -1), 0.5, black), ("BOX", (0, 0), (-1, -1), 1.0, black),
+    ("PADDING", (0, 0), (-1, -1), 4)
+])
+
+def _build_policy_table(w):
+    data = [
+        ["Policy", "Time / Detail"],
+        ["Standard Check-in Time:", "3:00 PM"], ["Standard Check-out Time:", "12:00 PM"],
+        ["Early Check-in/Late Out:", "Subject to availability. Request upon arrival."],
+        ["Required at Check-in:", "Passport & Credit Card/Cash Deposit."]
+    ]
+    t = Table(data, colWidths=[170, w - 170])
+    t.setStyle(POLICY_TABLE_STYLE)
+    return t
+
+def _draw_policy_table(c, w):
+    """Draws the policy table with its bottom-left corner at the origin; returns its height."""
+    pt = _build_policy_table(w)
+    _, ph = pt.wrapOn(c, w, 9999)
+    pt.drawOn(c, 0, 0)
+    return ph
+
+def _draw_footer(c, w, left):
+    draw_vector_seal(c, w - 130, 45)
+    c.setStrokeColor(BRAND_ORANGE); c.setLineWidth(2); c.line(0, FOOTER_LINE_Y, w, FOOTER_LINE_Y)
+    c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 8)
+    c.drawString(left, 30, f"Issued by: {COMPANY_NAME}")
+    c.drawString(left, 20, f"Email: {COMPANY_EMAIL}")
+    c.drawString(left, 10, "Odaduu Japan : 1 Chome-3-12 Takadanobaba, Shinjuku, Tokyo 169-0075")
+
+def _static_form(c, name, draw, *args):
+    """Records draw(c, *args) as a Form XObject the first time this canvas needs it.
+
+    Returns draw's result (e.g. the height it used), which is cached with the form. Callers place
+    the form themselves with c.doForm(name), so the static voucher chrome is stored once per PDF.
+    """
+    results = c.__dict__.setdefault("_static_forms", {})
+    if name not in results:
+        c.beginForm(name)
+        results[name] = draw(c, *args)
+        c.endForm()
+    return results[name]
+
+TNC_LINES = [
+    "• Voucher Validity: This voucher is for the dates and services specified above. It must be presented at the hotel's front desk upon arrival.",
+    "• Identification: The lead guest, {lead_guest}, must be present at check-in and must present valid government-issued photo identification.",
+    '• No-Show Policy: In the event of a "no-show", the hotel reserves the right to charge a fee, typically equivalent to the full cost of the stay.',
+    "• Payment/Incidental Charges: The reservation includes the room and breakfast as specified. Any other charges (e.g., mini-bar, laundry) must be settled by the guest directly.",
+    "• Occupancy: The room is confirmed for the number of guests mentioned above. Any change in occupancy must be approved by the hotel.",
+    "• Hotel Rights: The hotel reserves the right to refuse admission or request a guest to leave for inappropriate conduct.",
+    "• Liability: The hotel is not responsible for the loss or damage of personal belongings unless deposited in the hotel's safety deposit box.",
+    "• Reservation Non-Transferable: This booking is non-transferable and may not be resold.",
+    "• City Tax: City tax (if any) is not included and must be paid and settled directly at the hotel.",
+    "• Bed Type: Bed type is subject to availability and cannot be guaranteed."
+]
+TNC_TABLE_STYLE = TableStyle([
+    ("VALIGN", (0,0), (-1,-1), "TOP"), ("BOX", (0,0), (-1,-1), 1.0, black),
+    ("PADDING", (0,0), (-1,-1), 2), ("LINEBELOW", (0,0), (-1,-2), 0.25, lightgrey)
+])
+
+@lru_cache(maxsize=None)
+def _tnc_style(font_size):
+    return ParagraphStyle("tnc", parent=BASE_STYLES["Normal"], fontName="Times-Roman", fontSize=font_size, leading=font_size+1.5, textColor=black)
+
+@lru_cache(maxsize=None)
+def _tnc_row_heights(w, font_size):
+    """T&C row heights, measured once per width and font size.
+
+    The line naming the lead guest is left as None so each page's Table measures only that row. Only
+    the numbers are shared: flowables hold the canvas while drawing, so paragraphs are per canvas.
+    """
+    t = Table([[Paragraph(line, _tnc_style(font_size))] for line in TNC_LINES], colWidths=[w])
+    t.setStyle(TNC_TABLE_STYLE)
+    t.wrap(w, 9999)
+    return [None if "{lead_guest}" in line else rh for line, rh in zip(TNC_LINES, t._rowHeights)]
+
+def _tnc_fixed_paragraphs(c, w, font_size):
+    """The T&C lines that never change, built once per canvas (None for the lead guest line)."""
+    paras = c.__dict__.setdefault("_tnc_paragraphs", {})
+    if (w, font_size) not in paras:
+        paras[w, font_size] = [None if "{lead_guest}" in line else _FixedParagraph(line, _tnc_style(font_size)) for line in TNC_LINES]
+    return paras[w, font_size]
+
+def _build_tnc_table(c, w, lead_guest, font_size=7):
+    paras = _tnc_fixed_paragraphs(c, w, font_size)
+    rows = [[p or Paragraph(line.format(lead_guest=lead_guest), _tnc_style(font_size))] for p, line in zip(paras, TNC_LINES)]
+    t = Table(rows, colWidths=[w], rowHeights=_tnc_row_heights(w, font_size))
+    t.setStyle(TNC_TABLE_STYLE)
+    return t
+
+def _render_pages(c, data, hotel_info, rooms_list, imgs, on_page=None):
+    w, h = A4
+    left = 40; right = w - 40; top = h - 40; content_w = right - left
+    imgs = [ImageReader(io.BytesIO(im)) if isinstance(im, bytes) else im for im in imgs]
+
+    # Everything except the guest name, pax and confirmation number is the same on every page:
+    # build those cells once and measure their rows once, so each page only wraps what changed
+    guest_cols, hotel_cols, room_cols = [90, (content_w/2) - 100], [70, (content_w/2) - 80], [90, content_w - 110]
+    remarks_p = _FixedParagraph(data["remarks"] if data["remarks"] else "N/A", REMARK_STYLE)
+    room_p = _FixedParagraph(data["room_type"], ADDR_STYLE)
+
+    addr_str = f"{hotel_info.get('addr1','')}\n{hotel_info.get('addr2','')}".strip()
+    hotel_rows = [
+        ["Hotel:", _FixedParagraph(data["hotel"], ADDR_STYLE)],
+        ["Address:", _FixedParagraph(addr_str.replace('\n', '<br/>'), ADDR_STYLE)],
+        ["Check-In:", data["checkin"].strftime("%d %b %Y")],
+        ["Check-Out:", data["checkout"].strftime("%d %b %Y")],
+    ]
+    t_hotel = _info_table("HOTEL DETAILS", hotel_rows, hotel_cols, _measure_rows("HOTEL DETAILS", hotel_rows, hotel_cols))
+
+    def guest_rows(room):
+        pax_str = f'{room["adults"]} Adults'
+        if room["children"] > 0:
+            pax_str += f', {room["children"]} Children'
+        return [
+            ["Guest Name:", Paragraph(room["guest"], ADDR_STYLE)],
+            ["No. of Pax:", pax_str],
+            ["Cancellation:", data["cancellation"]],
+            ["Remarks:", remarks_p]
+        ]
+
+    def room_rows(room):
+        return [
+            ["Room Type:", room_p],
+            ["Room Size:", data["room_size"] or "N/A"],
+            ["Confirmation No.:", room["conf"]],
+            ["Meal Plan:", data["meal_plan"]],
+            ["No. of Nights:", str(data["nights"])],
+        ]
+
+    sample = rooms_list[0] if rooms_list else {"guest": "", "conf": "", "adults": 2, "children": 0}
+    guest_heights = _measure_rows("GUEST INFORMATION", guest_rows(sample), guest_cols, dynamic=(0, 1))
+    room_heights = _measure_rows("ROOM INFORMATION", room_rows(sample), room_cols, dynamic=(2,))
+
+    for idx, room in enumerate(rooms_list):
+        if idx > 0: c.showPage()
+        
+        y = _static_form(c, "voucher_header", _draw_header, w, top)
+        c.doForm("voucher_header")
+
+        t_guest = _info_table("GUEST INFORMATION", guest_rows(room), guest_cols, guest_heights)
+        t_room = _info_table("ROOM INFORMATION", room_rows(room), room_cols, room_heights)
+
+        scale = 1.0
+        tnc_font = 7
+        y = _draw_merged_info_box(c, left, y, content_w, t_guest, t_hotel, t_room)
+        space_left = y - MIN_CONTENT_Y
+        
+        if space_left < 320:
+            scale = 0.8
+            tnc_font = 6
+            
+        y = _draw_image_row(c, left, y, content_w, imgs, scale)
+
+        y -= 8
+        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 10.6); c.drawString(left, y, "HOTEL POLICIES"); y -= 10
+        ph = _static_form(c, "voucher_policies", _draw_policy_table, content_w)
+        if y - ph < MIN_CONTENT_Y: 
+            tnc_font = 5.5 
+        c.saveState(); c.translate(left, y - ph); c.doForm("voucher_policies"); c.restoreState()
+        y -= (ph + 12)
+        
+        c.setFillColor(BRAND_BLUE); c.setFont("Helvetica-Bold", 10); c.drawString(left, y, "TERMS & CONDITIONS"); y -= 8
+        lead_guest = room["guest"].split(',')[0] if room["guest"] else "Guest"
+        
+        if y - MIN_CONTENT_Y < 120: tnc_font = 5
+            
+        tnc = _build_tnc_table(c, content_w, lead_guest, tnc_font)
+        _, th = tnc.wrapOn(c, content_w, 9999)
+        tnc.drawOn(c, left, y - th)
+
+        _static_form(c, "voucher_footer", _draw_footer, w, left)
+        c.doForm("voucher_footer")
+        if on_page: on_page(idx + 1)
+
+def _render_chunk(data, hotel_info, rooms_list, imgs, path):
+    """Renders a slice of rooms to a standalone PDF file (process-pool entry point)."""
+    c = canvas.Canvas(path, pagesize=A4)
+    _render_pages(c, data, hotel_info, rooms_list, imgs)
+    c.save()
+    return path
+
+def _spooled_output():
+    """Output file for a finished voucher: kept in memory while small, rolled over to disk past PDF_SPOOL_MAX_BYTES."""
+    return tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+
+def _merge_pdfs(paths, out):
+    writer = pypdf.PdfWriter()
+    for path in paths: writer.append(pypdf.PdfReader(path))
+    # Every part embedded its own copy of the logo, fonts and hotel images; keep one of each
+    writer.compress_identical_objects()
+    writer.write(out)
+
+def _chunk_key(data, hotel_info, rooms, img_digests):
+    logo = os.path.getmtime(LOGO_FILE) if os.path.exists(LOGO_FILE) else None
+    payload = json.dumps({"v": RENDER_VERSION, "logo": logo, "data": data, "info": hotel_info, "rooms": rooms, "imgs": img_digests},
+                         sort_keys=True, default=str)
+    return f"pages:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+def _room_chunks(rooms_list):
+    """Splits rooms into chunks ending after each room whose content hash is 0 mod RENDER_CHUNK_ROOMS (or at RENDER_CHUNK_MAX rooms).
+
+    Boundaries depend only on the rooms themselves, so inserting or deleting a room changes the chunk it
+    lands in (splitting or joining at most one neighbour) instead of shifting every chunk after it.
+    """
+    chunks, cur = [], []
+    for room in rooms_list:
+        cur.append(room)
+        h = int.from_bytes(hashlib.sha256(json.dumps(room, sort_keys=True, default=str).encode("utf-8")).digest()[:8], "big")
+        if h % RENDER_CHUNK_ROOMS == 0 or len(cur) >= RENDER_CHUNK_MAX: chunks.append(cur); cur = []
+    if cur: chunks.append(cur)
+    return chunks
+
+def _render_parts(data, hotel_info, rooms_list, imgs, parallel=True, progress=None):
+    """Renders rooms_list as standalone PDFs, one per _room_chunks chunk, and returns an iterator over their bytes, in order.
+
+    Each chunk is cached in PAGE_CACHE under a hash of its rooms plus the shared booking fields, hotel
+    info and image bytes, so editing, adding or removing one room re-renders only that room's chunk.
+    Missing chunks go to a process pool when there are several (and `parallel`), otherwise render here.
+    Parts are read from the cache or the renderer's temp file only when the iterator reaches them.
+    `progress(pages_done)` counts cached chunks up front, then pages (serial) or chunks (parallel).
+
+    Returns None when the cache is disabled or the images are not plain bytes.
+    """
+    if not rooms_list or not PAGE_CACHE_MAX_BYTES: return None
+    if any(im is not None and not isinstance(im, bytes) for im in imgs): return None
+    digests = [hashlib.sha256(im).hexdigest() if im else None for im in imgs]
+    chunks = _room_chunks(rooms_list)
+    keys = [_chunk_key(data, hotel_info, chunk, digests) for chunk in chunks]
+    return _iter_parts(data, hotel_info, chunks, keys, imgs, parallel, progress)
+
+def _iter_parts(data, hotel_info, chunks, keys, imgs, parallel, progress):
+    missing = {i for i, key in enumerate(keys) if not PAGE_CACHE.has(key)}
+    done = sum(len(chunk) for i, chunk in enumerate(chunks) if i not in missing)
+    if progress and done: progress(done)
+
+    with tempfile.TemporaryDirectory(prefix="voucher-") as tmp:
+        def path(i): return os.path.join(tmp, f"part{i}.pdf")
+        workers = min(RENDER_WORKERS, len(missing)) if parallel else 1
+        pool, futures = None, {}
+        if workers > 1:
+            try:
+                pool = process_pool(workers)
+                futures = {i: pool.submit(_render_chunk, data, hotel_info, chunks[i], imgs, path(i)) for i in sorted(missing)}
+            except Exception as e:
+                print(f"Parallel render failed, rendering serially: {e}")
+        try:
+            for i, chunk in enumerate(chunks):
+                part = None if i in missing else PAGE_CACHE.get(keys[i])
+                if part is None:
+                    pending, fut = True, futures.pop(i, None)
+                    if fut is not None:
+                        try: fut.result(); pending = False
+                        except Exception as e: print(f"Parallel render failed, rendering this chunk serially: {e}")
+                    # A chunk evicted since the has() check was already counted as done
+                    step = len(chunk) if i in missing else 0
+                    if pending:
+                        c = canvas.Canvas(path(i), pagesize=A4)
+                        _render_pages(c, data, hotel_info, chunk, imgs, (lambda n, base=done: progress(base + n)) if progress and step else None)
+                        c.save()
+                    done += step
+                    if progress and step: progress(done)
+                    with open(path(i), "rb") as fh: part = fh.read()
+                    os.remove(path(i))
+                    PAGE_CACHE.set(keys[i], part)
+                yield part
+                del part
+        finally:
+            if pool: pool.shutdown(cancel_futures=True)
+
+def _render_cached(data, hotel_info, rooms_list, imgs, out, parallel=True, progress=None):
+    """Renders via _render_parts and merges the chunks page-for-page into `out`; False (nothing written) if it declined."""
+    parts = _render_parts(data, hotel_info, rooms_list, imgs, parallel, progress)
+    if parts is None: return False
+    parts = list(parts)
+    if len(parts) > 1: _merge_pdfs([io.BytesIO(part) for part in parts], out)
+    elif isinstance(out, (str, os.PathLike)):
+        with open(out, "wb") as fh: fh.write(parts[0])
+    else: out.write(parts[0])
+    return True
+
+def voucher_data(hotel, checkin, checkout, room_type, meal_plan="Breakfast Only", cancellation="Non-Refundable", room_size="", remarks=""):
+    """The shared (non-room) fields of a voucher, as generate_pdf_final expects them."""
+    nights = max((checkout - checkin).days, 1)
+    return {
+        "hotel": hotel, "checkin": checkin, "checkout": checkout,
+        "room_type": room_type, "meal_plan": meal_plan,
+        "cancellation": cancellation, "nights": nights, "room_size": room_size, "remarks": remarks
+    }
+
+def manifest_rooms(records):
+    """bulk_data / normalize_manifest records -> the room dicts generate_pdf_final renders."""
+    return [{
+        "guest": str(r.get("Guest Name", "")),
+        "conf": str(r.get("Confirmation No", "")),
+        "adults": int(r.get("Adults", 2)),
+        "children": int(r.get("Children", 0))
+    } for r in records]
+
+class RoomEntry:
+    """One manually entered room. The app keeps a plain list of these instead of per-field session keys."""
+    __slots__ = ("guest", "conf", "adults", "children")
+
+    def __init__(self, guest="", conf="", adults=2, children=0):
+        self.guest, self.conf, self.adults, self.children = guest, conf, adults, children
+
+    def as_room(self, conf=None):
+        return {"guest": self.guest, "conf": self.conf if conf is None else conf, "adults": self.adults, "children": self.children}
+
+def generate_pdf_final(data, hotel_info, rooms_list, imgs, out=None, parallel=True, progress=None):
+    """Renders one page per room straight into `out` (a file path or binary file) and returns it.
+
+    Without `out` the PDF goes to a spooled temporary file, returned rewound; close it once served.
+    Unchanged chunks of rooms come from PAGE_CACHE (see _render_cached). Pass parallel=False from code
+    that is already running inside a worker pool. `progress(pages_done)` reports pages as they are done.
+    """
+    imgs = prepare_images(imgs)
+    if out is None: out = _spooled_output()
+    if not _render_cached(data, hotel_info, rooms_list, imgs, out, parallel, progress):
+        c = canvas.Canvas(out, pagesize=A4)
+        _render_pages(c, data, hotel_info, rooms_list, imgs, progress)
+        c.save()
+    if hasattr(out, "seek"): out.seek(0)
+    return out
+
+def room_pdf_names(rooms_list):
+    """One file name per room, "<guest>_<conf>.pdf", made unique by unique_file_names."""
+    return unique_file_names(
+        ["_".join(file_slug(v) for v in (room["guest"], room["conf"]) if re.search(r"[A-Za-z0-9]", str(v))) or f"room{i+1}"
+         for i, room in enumerate(rooms_list)], ".pdf")
+
+def _zip_pages(zf, part, names):
+    """Writes each page of one rendered part to `zf` as its own PDF, named from the `names` iterator."""
+    for page in pypdf.PdfReader(io.BytesIO(part) if isinstance(part, bytes) else part).pages:
+        writer, buf = pypdf.PdfWriter(), io.BytesIO()
+        writer.add_page(page); writer.write(buf)
+        zf.writestr(next(names), buf.getvalue())
+    if hasattr(part, "close"): part.close()
+
+def generate_voucher_zip(data, hotel_info, rooms_list, imgs, out=None, parallel=True, progress=None):
+    """Like generate_pdf_final, but writes a ZIP of one single-page PDF per room (see room_pdf_names).
+
+    Rooms render in the same cached chunks, across the same process pool, and each chunk is then split
+    page by page: every file reuses the chunk's already encoded logo, hotel images and static forms
+    instead of rendering and embedding them again. Each chunk is zipped as soon as it is read from the
+    cache or rendered, so only that chunk and the file being written are held in memory; entries are
+    deflated, which mostly wins back the ASCII85 overhead of the embedded images.
+    """
+    imgs = prepare_images(imgs)
+    if out is None: out = _spooled_output()
+    parts = _render_parts(data, hotel_info, rooms_list, imgs, parallel, progress)
+    if parts is None:
+        parts = [generate_pdf_final(data, hotel_info, rooms_list, imgs, parallel=False, progress=progress)]
+    names = iter(room_pdf_names(rooms_list))
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for part in parts: _zip_pages(zf, part, names)
+    if hasattr(out, "seek"): out.seek(0)
+    return out
+
+# =====================================
+# 6) BACKGROUND JOBS
+# =====================================
+
+def file_slug(text):
+    return re.sub(r"[^A-Za-z0-9]+", "_", str(text)).strip("_")[:80] or "voucher"
+
+def unique_file_names(stems, ext):
+    """stem + ext for each stem; a name already taken (ignoring case) gets the first free _2, _3... suffix."""
+    names, used = [], set()
+    for stem in stems:
+        name, n = f"{stem}{ext}", 1
+        while name.lower() in used:
+            n += 1; name = f"{stem}_{n}{ext}"
+        used.add(name.lower()); names.append(name)
+    return names
+
+class VoucherJobs:
+    """Runs voucher renders (hotel lookup, images, PDF) on a thread pool, tracking each one in a JobStore.
+
+    Finished PDFs (or per-room ZIPs) are written under `out_dir` and kept until the store purges them after `ttl` seconds.
+    """
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, store, out_dir, workers, ttl):
+        self.store, self.out_dir, self.ttl = store, out_dir, ttl
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="voucher-job")
+        store.fail_unfinished("Interrupted by a restart")
+
+    def submit(self, label, data, rooms_list, city="", hotel_info=None, imgs=None, split=False):
+        """Queues a voucher; hotel_info and imgs are looked up in the job when not given. Returns the job id.
+
+        With split=True the job produces a ZIP with one PDF per room (generate_voucher_zip).
+        """
+        self.store.purge(self.ttl)
+        job_id = self.store.create(label, len(rooms_list))
+        self.pool.submit(self._run, job_id, data, rooms_list, city, hotel_info, imgs, split)
+        return job_id
+
+    def _run(self, job_id, data, rooms_list, city, hotel_info, imgs, split):
+        self.store.update(job_id, status="running")
+        last = [0.0]
+        def progress(done):
+            if time.time() - last[0] >= self.PROGRESS_INTERVAL:
+                last[0] = time.time(); self.store.update(job_id, done=done)
+        try:
+            # Details and images are optional on the voucher: when rate limited, render without them and say so
+            warnings = []
+            if hotel_info is None:
+                try: hotel_info = fetch_hotel_details_text(data["hotel"], city, data["room_type"])
+                except Throttled as e:
+                    hotel_info = {}; warnings.append(f"no hotel details ({e.api} {e.reason})")
+            if not imgs or not any(imgs):
+                try: imgs = get_smart_images(data["hotel"], city)
+                except Throttled as e:
+                    imgs = [None] * 3; warnings.append(f"no hotel images ({e.api} {e.reason})")
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"{job_id}.{'zip' if split else 'pdf'}")
+            render = generate_voucher_zip if split else generate_pdf_final
+            render(data, hotel_info, rooms_list, imgs, out=path + ".tmp", progress=progress)
+            os.replace(path + ".tmp", path)
+            self.store.update(job_id, status="done", done=len(rooms_list), path=path,
+                              error=f"Rendered with {' and '.join(warnings)}" if warnings else None)
+            HOTEL_INDEX.add(data["hotel"], city)
+        except Exception as e:
+            print(f"Voucher job {job_id} failed: {e}")
+            self.store.update(job_id, status="failed", error=str(e))
+
+@lru_cache(maxsize=None)
+def voucher_jobs():
+    """The process-wide job runner, created on first use so importing the engine (e.g. from the CLI) leaves jobs alone."""
+    return VoucherJobs(JOB_STORE, os.path.join(CACHE_DIR, "jobs"), JOB_WORKERS, JOB_TTL)